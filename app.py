@@ -1,13 +1,22 @@
 import os
+import json
 import uuid
 import datetime
 
-import requests
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, g, render_template, request, jsonify, stream_with_context
 from flask_cors import CORS
-from llama_index import GPTSimpleVectorIndex, SimpleDirectoryReader, Document
-from newspaper import Article
+from werkzeug.utils import secure_filename
+from conversations import ConversationStore, SystemPrompt
+from fetch import fetch_pages
+from indexer import IndexWriter, content_id
+from jobs import DONE, JobQueue, JobQueueFull
+from lazy import Lazy, warm_up
+from llm_client import LLMError, get_client
+from metrics import REQUEST_SECONDS, render as render_metrics, stage, trace
+from retrieval import RETRIEVAL_TOKENS, RETRIEVAL_TOP_K, pack_context, retrieve
+from prompt_wizard import get_nlp
 from summarize import handle_text
+from tokens import CHAT_MODEL, count_message_tokens, truncate_tokens
 
 # Set up Flask app
 app = Flask(__name__)
@@ -18,186 +27,328 @@ API_KEY = os.getenv("OPENAI_API_KEY")
 
 current_date = datetime.datetime.now().strftime('%Y-%m-%d')
 
-# Initialize conversation history and index path
-index_path = "index.json"
-conversation_history = []  # Define conversation_history as a global variable
+# gpt-3.5-turbo has a 4096 token context, the reply needs CHAT_RESULT_TOKENS of it
+# and a few more are kept spare for the reply priming
+CHAT_RESULT_TOKENS = 500
+CHAT_CONTEXT_TOKENS = 4096 - CHAT_RESULT_TOKENS - 96
+# with notes retrieved from the index, the recent history only needs to carry the
+# thread of the conversation
+RETRIEVAL_HISTORY_TOKENS = 1500
+if RETRIEVAL_TOP_K > 0:
+    MAX_HISTORY_TOKENS = min(RETRIEVAL_HISTORY_TOKENS, CHAT_CONTEXT_TOKENS - RETRIEVAL_TOKENS)
+    # the newest message is never evicted, it may take the whole context but the notes
+    MAX_MESSAGE_CONTEXT_TOKENS = CHAT_CONTEXT_TOKENS - RETRIEVAL_TOKENS
+else:
+    MAX_HISTORY_TOKENS = CHAT_CONTEXT_TOKENS
+    MAX_MESSAGE_CONTEXT_TOKENS = CHAT_CONTEXT_TOKENS
+# set FOLD_HISTORY=1 to summarize turns that no longer fit instead of forgetting them,
+# the summary is kept to about this many characters
+FOLD_HISTORY = os.getenv("FOLD_HISTORY") == "1"
+MAX_HISTORY_SUMMARY_CHARS = 2000
+# set AUTO_ARCHIVE=1 to archive a session in the background once its unarchived turns
+# take AUTO_ARCHIVE_TOKENS of the history window, before truncation evicts them
+AUTO_ARCHIVE = os.getenv("AUTO_ARCHIVE") == "1"
+AUTO_ARCHIVE_TOKENS = int(os.getenv("AUTO_ARCHIVE_TOKENS", str(MAX_HISTORY_TOKENS // 2)))
+# load the index and the sentence segmentation in the background as soon as the app
+# starts, set WARM_UP=0 to load each on first use instead
+WARM_UP = os.getenv("WARM_UP", "1") == "1"
+
+
+# summarize the previous summary together with the turns evicted since
+def summarize_history(text):
+    return handle_text(text, max_summary_length=MAX_HISTORY_SUMMARY_CHARS)
+
+
+# Initialize the conversations, one per browser session
+system_prompt = SystemPrompt("system.txt")
+conversations = ConversationStore(system_prompt, summarizer=summarize_history if FOLD_HISTORY else None)
+
+
+# Load or create the index, see VECTOR_STORE
+def load_vector_store():
+    # imported here, llama_index takes seconds to import
+    from vector_store import open_vector_store
+    return open_vector_store()
+
+
+# the app serves requests while these load, see /ready
+vector_store = Lazy("index", load_vector_store)
+nlp = Lazy("sentence segmentation", get_nlp)
+if WARM_UP:
+    warm_up(vector_store, nlp)
+
+# inserts documents in the background, batched, and saves the index after each batch
+index_writer = IndexWriter(vector_store)
+
+# actions that can take minutes run as background jobs
+JOB_ACTIONS = {"summarize", "url", "archive"}
+# the actions besides chat
+ACTIONS = JOB_ACTIONS | {"query", "reset"}
+job_queue = JobQueue()
+
+# Queue content to be added to the index. The turns of a session, and what is archived
+# from them, are retrieved in that session only, other content is shared by every session
+def update_index(content, role, doc_id, session=None):
+    index_writer.add(content, doc_id, session)
+
+
+# Save content to data directory and return file_id, the content's hash, so the same
+# content is saved once and indexed under the same doc_id as ingest.py gives the file
+def save_to_data_directory(content):
+    os.makedirs("data", exist_ok=True)
 
+    file_id = content_id(content)
+    file_path = os.path.join("data", f"{file_id}.txt")
+    if os.path.exists(file_path):
+        return file_id
 
-# Load or create the index and initialize conversation history
-def load_or_create_index():
-    global conversation_history
-    conversation_history = []
+    # written whole or not at all, two jobs may save the same content at once
+    with stage("save_data"):
+        tmp_path = f"{file_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w", encoding="utf-8", newline="") as file:
+            file.write(content)
+        os.replace(tmp_path, file_path)
 
-    with open("system.txt", "r") as file:
-        system_content = file.read()
+    return file_id
 
-    conversation_history.append({"role": "system", "content": system_content})
 
-    if os.path.exists(index_path):
-        return GPTSimpleVectorIndex.load_from_disk(index_path)
-    else:
-        documents = SimpleDirectoryReader('data').load_data()
-        index = GPTSimpleVectorIndex.from_documents(documents)
-        index.save_to_disk(index_path)
-        return index
+# The conversation of the browser session making the request
+def current_conversation():
+    if "session_id" not in g:
+        g.session_id = request.cookies.get("session_id") or uuid.uuid4().hex
+    return conversations.get(g.session_id)
 
-llama_index = load_or_create_index()
 
-# Update index with the initial conversation_history
-def update_index(content, role, doc_id):
-    doc = Document(content, doc_id=doc_id)
-    llama_index.insert(doc)
-    llama_index.save_to_disk(index_path)
+@app.after_request
+def set_session_cookie(response):
+    if "session_id" in g and request.cookies.get("session_id") != g.session_id:
+        response.set_cookie("session_id", g.session_id, httponly=True, samesite="Lax")
+    return response
 
 
-# Save content to data directory and return file_id
-def save_to_data_directory(content):
-    if not os.path.exists("data"):
-        os.makedirs("data")
+def summarize_text(text, progress=None):
+    summary = handle_text(text, progress=progress)
 
-    file_id = str(uuid.uuid4())
-    file_path = os.path.join("data", f"{file_id}.txt")
+    # the summary's hash keeps notes written in the same second, by the pages of one url
+    # request or by concurrent jobs, apart
+    filename = ("notes/" + datetime.datetime.now().strftime('%Y-%m-%d_%H_%M_%S')
+                + f"_{content_id(summary)[:12]}_summary.md")
 
-    with open(file_path, "w") as file:
-        file.write(content)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
 
-    return file_id
+    with open(filename, "w") as file:
+        file.write(summary)
+        file.flush()
+        file.close()
 
+    return summary
 
-def scrape_url(url):
-    try:
-        article = Article(url)
-        article.download()
-        article.parse()
+# Add the user's chat message to the history and the index, keeping the history
+# within its token budget. Turns are indexed by content, a message repeated in any
+# session is embedded once. The history keeps the message even when it is over the
+# budget alone, cut to what fits in the chat context
+def add_user_message(conversation, prompt):
+    max_tokens = MAX_MESSAGE_CONTEXT_TOKENS - conversation.pinned_tokens() - count_message_tokens({"content": ""})
+    conversation.append("user", truncate_tokens(prompt, max_tokens, CHAT_MODEL))
+    update_index(prompt, "user", content_id(prompt), conversation.session_id)
+    if AUTO_ARCHIVE:
+        maybe_auto_archive(conversation)
+    conversation.truncate(MAX_HISTORY_TOKENS)
+
+
+# Summarize the turns since the session was last archived, append the summary to the
+# session's rolling note and index both. Earlier turns are never summarized again, so an
+# archive costs as many tokens as there are new turns. The caller holds archive_lock
+def archive_turns(conversation, messages, turns, progress=None):
+    if not messages:
+        return "Nothing new to archive since the last archive."
+
+    content = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+    summary = handle_text(content, progress=progress)
+
+    filename = f"notes/archive_{secure_filename(conversation.session_id)}.md"
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, "a") as file:
+        file.write(f"## {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n{summary}\n\n")
 
-        text = article.text
-        return text
-    except:
-        return None
+    # Add the new turns and their summary to the index
+    update_index(content, "user", save_to_data_directory(content), conversation.session_id)
+    update_index(summary, "assistant", save_to_data_directory(summary), conversation.session_id)
 
+    conversation.mark_archived(turns)
+    return summary
 
-# Count characters in a text
-def count_characters(text):
-    return len(text)
 
+def archive_conversation(conversation, progress=None):
+    with conversation.archive_lock:
+        messages, turns = conversation.unarchived()
+        return archive_turns(conversation, messages, turns, progress)
 
-# Truncate conversation_history to keep it below 8000 characters
-def truncate_conversation_history():
-    global conversation_history
-    total_characters = sum([count_characters(msg["content"]) for msg in conversation_history])
-    while total_characters > 8000:
-        removed_message = conversation_history.pop(0)
-        total_characters -= count_characters(removed_message["content"])
 
+# Start archiving the session in the background once enough turns are unarchived. The
+# turns are taken now, truncating the window afterwards does not lose them
+def maybe_auto_archive(conversation):
+    if conversation.unarchived_tokens() < AUTO_ARCHIVE_TOKENS:
+        return
+    if not conversation.archive_lock.acquire(blocking=False):
+        return
 
-def reset_conversation_history():
-    global conversation_history
-    conversation_history = []
+    messages, turns = conversation.unarchived()
 
-    with open("system.txt", "r") as file:
-        system_content = file.read()
+    def work(progress):
+        try:
+            return archive_turns(conversation, messages, turns, progress)
+        finally:
+            conversation.archive_lock.release()
 
-    conversation_history.append({"role": "system", "content": system_content})
+    try:
+        job_queue.submit("archive", work)
+    except JobQueueFull:
+        # tried again on the next turn
+        conversation.archive_lock.release()
 
 
-def summarize_text(text):
-    summary = handle_text(text)
+# Add the assistant's reply to the history and the index. A summary saved to the data
+# directory has the same id, so it is not indexed twice
+def add_assistant_message(conversation, bot_response):
+    conversation.append("assistant", bot_response)
+    update_index(bot_response, "assistant", content_id(bot_response), conversation.session_id)
 
-    filename = "notes/" + datetime.datetime.now().strftime('%Y-%m-%d_%H_%M_%S') + "_summary.md"
 
-    os.makedirs(os.path.dirname(filename), exist_ok=True)
+# Add the user's chat message and return the messages for the chat API, with the
+# index notes most similar to the message placed just before it
+def chat_messages(conversation, prompt):
+    with conversation.lock:
+        add_user_message(conversation, prompt)
+        messages = conversation.messages()
 
-    with open(filename, "w") as file:
-        file.write(summary)
-        file.flush()
-        file.close()
+    # until the index is loaded chat goes on without notes rather than waiting for it
+    hits = retrieve(vector_store.get(), prompt, conversation.session_id) if vector_store.ready else []
+    context = pack_context(hits, exclude=[message["content"] for message in messages])
+    if context is not None:
+        messages.insert(len(messages) - 1, context)
+    return messages
 
-    return summary
 
-# Get GPT response based on user input
-def get_gpt_response(action, prompt):
-    global conversation_history
+# Get GPT response based on user input, progress is passed on to long running actions.
+# Timed by action, and traced to TRACE_LOG when it is set
+def get_gpt_response(conversation, action, prompt, progress=None):
+    # anything else is answered by chat, and timed as chat, so clients cannot add labels
+    label = action if action in ACTIONS else "general"
+    with trace(label), REQUEST_SECONDS.time(action=label):
+        return respond(conversation, action, prompt, progress)
+
+
+def respond(conversation, action, prompt, progress=None):
     if action == "summarize":
         # Add the original text to the index before summarization
         file_id_original = save_to_data_directory(prompt)
         update_index(prompt, "user", file_id_original)
 
-        bot_response = summarize_text(prompt)
+        bot_response = summarize_text(prompt, progress)
 
         # Add the summarized text to the index after summarization
         file_id_summary = save_to_data_directory(bot_response)
         update_index(bot_response, "assistant", file_id_summary)
     elif action == "query":
-        response = llama_index.query(prompt)
-        bot_response = str(response)
+        bot_response = vector_store.get().answer(prompt, session=conversation.session_id)
     elif action == "archive":
-        # Combine the content of conversation_history into a single string
-        content = "\n".join([msg["content"] for msg in conversation_history])
-        bot_response = summarize_text(content)
-
-        # Add the original content to the index before summarization
-        file_id_original = save_to_data_directory(content)
-        update_index(content, "user", file_id_original)
-
-        # Add the summarized content to the index after summarization
-        file_id_summary = save_to_data_directory(bot_response)
-        update_index(bot_response, "assistant", file_id_summary)
+        bot_response = archive_conversation(conversation, progress)
     elif action == "reset":
-        reset_conversation_history()
+        conversation.reset()
         bot_response = "Conversation history has been reset."
 
     elif action == "url":
-        content = scrape_url(prompt)
-        if content:
-            bot_response = summarize_text(content)
+        # one or more URLs, separated by whitespace, fetched concurrently
+        urls = prompt.split()
+        if progress is not None:
+            progress(f"Fetching {len(urls)} pages" if len(urls) > 1 else "Fetching page")
+        pages = fetch_pages(urls)
+
+        responses = []
+        for page in pages:
+            if page.text is None:
+                print(f"error fetching {page.url}: {page.error}")
+                responses.append(f"{page.url}: unable to retrieve the page ({page.error})")
+                continue
+
+            summary = summarize_text(page.text, progress)
 
             # Add the original content to the index before summarization
-            file_id_original = save_to_data_directory(content)
-            update_index(content, "user", file_id_original)
+            file_id_original = save_to_data_directory(page.text)
+            update_index(page.text, "user", file_id_original)
 
             # Add the summarized content to the index after summarization
-            file_id_summary = save_to_data_directory(bot_response)
-            update_index(bot_response, "assistant", file_id_summary)
-        else:
+            file_id_summary = save_to_data_directory(summary)
+            update_index(summary, "assistant", file_id_summary)
+            responses.append(summary if len(pages) == 1 else f"{page.url}\n\n{summary}")
+
+        if all(page.text is None for page in pages):
             bot_response = "Error: Unable to retrieve or process content from the provided URL."
-    else:
-        headers = {"Authorization": f"Bearer {API_KEY}"}
-        conversation_history.append({"role": "user", "content": prompt})
-        update_index(prompt, "user", f"user_{len(conversation_history) - 1}")
-        truncate_conversation_history()
-        data = {
-            "model": "gpt-3.5-turbo",
-            "messages": conversation_history,
-            "max_tokens": 500,
-            "temperature": 0.9,
-        }
-        response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=data)
-
-        if response.status_code == 200:
-            bot_response = response.json()['choices'][0]['message']['content'].strip()
         else:
-            return f"Error: {response.status_code}"
-
-    conversation_history.append({"role": "assistant", "content": bot_response})
-    update_index(bot_response, "assistant", f"assistant_{len(conversation_history) - 1}")
+            bot_response = "\n\n".join(responses)
+    else:
+        messages = chat_messages(conversation, prompt)
+        bot_response = get_client(API_KEY).chat(messages, max_tokens=CHAT_RESULT_TOKENS, temperature=0.9)
+
+    with conversation.lock:
+        add_assistant_message(conversation, bot_response)
+        # the reply to an archive is the archive's summary, it needs no archiving itself
+        if action == "archive" and conversation.archived_turns == conversation.turns - 1:
+            conversation.mark_archived(conversation.turns)
     return bot_response
 
 
+# Stream the GPT chat response as server-sent events: a "delta" event for each piece
+# of the reply, then a "done" event with the full reply, or an "error" event
+def stream_gpt_response(conversation, prompt):
+    def sse(event, data):
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    def generate():
+        pieces = []
+        with trace("stream"), REQUEST_SECONDS.time(action="stream"):
+            messages = chat_messages(conversation, prompt)
+            try:
+                for content in get_client(API_KEY).stream_chat(messages, max_tokens=CHAT_RESULT_TOKENS, temperature=0.9):
+                    pieces.append(content)
+                    yield sse("delta", {"content": content})
+            except LLMError as e:
+                yield sse("error", {"response": f"Error: {e}"})
+                return
+
+            bot_response = "".join(pieces).strip()
+            with conversation.lock:
+                add_assistant_message(conversation, bot_response)
+        yield sse("done", {"response": bot_response})
+
+    return generate()
+
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
+# 200 once the index and the sentence segmentation are loaded, 503 until then
+@app.route('/ready', methods=['GET'])
+def ready():
+    resources = {resource.name: resource.to_dict() for resource in (vector_store, nlp)}
+    is_ready = all(resource["ready"] for resource in resources.values())
+    return jsonify({'ready': is_ready, 'resources': resources}), 200 if is_ready else 503
+
+# request times by action and stage, API calls, tokens and retries, in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/system', methods=['GET'])
 def get_system_content():
-    with open("system.txt", "r") as file:
-        content = file.read()
-    return jsonify({'content': content})
+    return jsonify({'content': system_prompt.content})
 
 @app.route('/system', methods=['POST'])
 def update_system_content():
     content = request.form['content']
-    with open("system.txt", "w") as file:
-        file.write(content)
+    system_prompt.update(content)
     return jsonify({'message': 'System content updated successfully'})
 
 @app.route('/message', methods=['POST'])
@@ -205,12 +356,57 @@ def message():
     user_input = request.form['input']
     action = request.form['action']
     print(f"Action: {action}")
-    response = get_gpt_response(action, user_input)
+    conversation = current_conversation()
+    if action in JOB_ACTIONS:
+        try:
+            job = job_queue.submit(action, lambda progress: get_gpt_response(conversation, action, user_input, progress))
+        except JobQueueFull as e:
+            return jsonify({'response_type': 'error', 'response': f"Error: {e}"})
+        return jsonify({'response_type': 'job', 'job': job.to_dict()})
+
+    try:
+        response = get_gpt_response(conversation, action, user_input)
+    except LLMError as e:
+        response = f"Error: {e}"
     if response.startswith("Error"):
         return jsonify({'response_type': 'error', 'response': response})
     else:
         return jsonify({'response_type': 'success', 'response': response})
 
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'job not found'}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'job not found'}), 404
+    if not job.is_finished:
+        return jsonify(job.to_dict()), 202
+    if job.status != DONE:
+        return jsonify({'response_type': 'error', 'response': job.error or f"Error: job {job.status}"})
+    if job.result.startswith("Error"):
+        return jsonify({'response_type': 'error', 'response': job.result})
+    return jsonify({'response_type': 'success', 'response': job.result})
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    job = job_queue.cancel(job_id)
+    if job is None:
+        return jsonify({'error': 'job not found'}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/message/stream', methods=['POST'])
+def message_stream():
+    user_input = request.form['input']
+    print("Action: general (streaming)")
+    return Response(stream_with_context(stream_gpt_response(current_conversation(), user_input)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 
 if __name__ == '__main__':
     app.run(host="127.0.0.1", port=5000, debug=True)
@@ -0,0 +1,1230 @@
+"""
+Offline benchmarks for the summarization pipeline.
+
+Every benchmark runs against a local mock of the OpenAI completions and chat APIs, so no
+API key or network access is needed and the results are reproducible.
+
+usage: python benchmark.py sections [--latency 0.05] [--concurrency 8] [--counts 1 4 16 32]
+       python benchmark.py extraction [--latency 0.05] [--counts 1 4 16]
+       python benchmark.py fetch [--pages 32] [--latency 0.2] [--concurrency 8]
+       python benchmark.py extractive [--cues 200 1000 4000] [--ratio 0.3]
+       python benchmark.py segmentation [--size 1000000] [--model en_core_web_sm]
+       python benchmark.py budget [--sizes 8000 12000 14000 16000 24000 48000]
+       python benchmark.py prompt [--counts 100 200 400 800 1600]
+       python benchmark.py compress [--latency 0.05] [--concurrency 4] [--counts 4 16 64]
+       python benchmark.py defragment [--sizes 20000 50000 100000 200000] [--ratio 0.3]
+       python benchmark.py chat [--latency 0.3] [--token-latency 0.05]
+       python benchmark.py history [--turns 10000] [--max-tokens 3500]
+       python benchmark.py vectors [--counts 10000 100000 1000000] [--dim 384] [--legacy-max 10000]
+       python benchmark.py startup [--documents 1000] [--runs 3]
+       python benchmark.py ingest [--files 1000] [--latency 0.05] [--concurrency 1 2 4 8]
+       python benchmark.py suite [--rounds 3] [--latency 0.02] [--error-rate 0.05] [--output results.json]
+                                 [--compare baseline.json] [--scenarios summarize_srt message_chat ...]
+"""
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, List, Optional
+
+MOCK_SUMMARY = "Mock heading\n\nThis is a mock summary of the section."
+MOCK_EXTRACTION = json.dumps({"topics": [{"heading": "Mock heading", "paragraph": "This is a mock summary of the section."}],
+                              "tags": ["mock", "summary"]})
+WORDS = ("the quick brown fox jumps over a lazy dog while the market rallies and the "
+         "historian explains why empires rise and fall over long periods of time").split()
+MOCK_EMBEDDING_DIM = 64
+MOCK_USAGE = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+
+
+class MockCompletionsHandler(BaseHTTPRequestHandler):
+    """
+    Answers /v1/completions, /v1/chat/completions and embeddings like the OpenAI API does,
+    after `latency` seconds; streamed chat replies send one word every `token_latency` seconds.
+    Completions are MOCK_SUMMARY (MOCK_EXTRACTION when the prompt asks for JSON), or with
+    `compression_ratio` set the end of the prompt shortened to that share of its words, so
+    compressed text has a realistic size. With `error_rate` set, that share of the completion
+    and chat requests fails with a 503 the client retries
+    """
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    latency = 0.0
+    token_latency = 0.0
+    compression_ratio = None
+    error_rate = 0.0
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        with self.server.lock:
+            self.server.calls += 1
+            # drawn from a seeded generator, a run fails the same share of requests every time
+            failed = (self.error_rate > 0 and not self.path.endswith("/embeddings")
+                      and self.server.rng.random() < self.error_rate)
+            self.server.errors += 1 if failed else 0
+        time.sleep(self.latency)
+
+        if failed:
+            body = json.dumps({"error": {"message": "mock server overloaded", "type": "server_error"}}).encode()
+            self.send_response(503)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        if self.path.endswith("/embeddings"):
+            inputs = payload.get("input", [])
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            self.send_json({"data": [{"index": i, "embedding": mock_embedding(text)} for i, text in enumerate(inputs)],
+                            "usage": {"prompt_tokens": 0, "total_tokens": 0}})
+        elif not self.path.endswith("/chat/completions"):
+            self.send_json({"choices": [{"text": self.completion(payload), "finish_reason": "stop"}],
+                            "usage": MOCK_USAGE})
+        elif payload.get("stream"):
+            self.send_stream(MOCK_SUMMARY.split(" "))
+        else:
+            # the whole reply is generated before any of it is sent
+            time.sleep(self.token_latency * len(MOCK_SUMMARY.split(" ")))
+            self.send_json({"choices": [{"message": {"role": "assistant", "content": MOCK_SUMMARY},
+                                         "finish_reason": "stop"}], "usage": MOCK_USAGE})
+
+    def completion(self, payload: dict) -> str:
+        prompt = str(payload.get("prompt", ""))
+        if "Answer with JSON" in prompt:
+            return MOCK_EXTRACTION
+        if not self.compression_ratio:
+            return MOCK_SUMMARY
+        words = prompt.split()
+        # about 4 words in 3 tokens
+        count = max(1, min(int(len(words) * self.compression_ratio), payload.get("max_tokens", 16) * 3 // 4))
+        return " ".join(words[-count:]).rstrip(".") + "."
+
+    def send_json(self, data: dict):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_stream(self, words):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        for i, word in enumerate(words):
+            delta = {"content": word if i == 0 else " " + word}
+            self.send_chunk("data: %s\n\n" % json.dumps({"choices": [{"delta": delta, "finish_reason": None}]}))
+            time.sleep(self.token_latency)
+        self.send_chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def send_chunk(self, text: str):
+        data = text.encode()
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+# a bag of words embedding, texts sharing words are similar
+def mock_embedding(text) -> list:
+    vector = [0.0] * MOCK_EMBEDDING_DIM
+    for word in str(text).lower().split():
+        vector[zlib.crc32(word.encode()) % MOCK_EMBEDDING_DIM] += 1.0
+    return vector
+
+
+def start_mock_server(latency: float, token_latency: float = 0.0,
+                      compression_ratio: Optional[float] = None, error_rate: float = 0.0) -> ThreadingHTTPServer:
+    handler = type("Handler", (MockCompletionsHandler,), {"latency": latency, "token_latency": token_latency,
+                                                          "compression_ratio": compression_ratio,
+                                                          "error_rate": error_rate})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.calls = 0
+    server.errors = 0
+    server.rng = random.Random(0)
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def use_mock_server(server: ThreadingHTTPServer):
+    # must run before prompt_wizard/summarize are imported
+    os.environ["OPENAI_API_BASE"] = "http://127.0.0.1:%d/v1" % server.server_address[1]
+    os.environ.setdefault("OPENAI_API_KEY", "mock")
+    # timings must measure the pipeline, not the response cache
+    os.environ["LLM_CACHE"] = "0"
+
+
+def make_text(chars: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    sentences = []
+    length = 0
+    while length < chars:
+        sentence = " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 20))).capitalize() + ". "
+        sentences.append(sentence)
+        length += len(sentence)
+    return "".join(sentences)
+
+
+def bench_sections(args):
+    server = start_mock_server(args.latency)
+    use_mock_server(server)
+    import summarize
+    from prompt_wizard import get_nlp
+
+    get_nlp()
+    print("sections  serial(s)  concurrent(s)  speedup")
+    for count in args.counts:
+        # each section is just under the default max_section_length of 5000 chars
+        text = make_text(count * 4800, seed=count)
+        timings = []
+        for concurrency in (1, args.concurrency):
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                summarize.handle_text(text, concurrency=concurrency)
+            timings.append(time.perf_counter() - start)
+        print("%8d  %9.2f  %13.2f  %6.1fx" % (count, timings[0], timings[1], timings[0] / timings[1]))
+
+    server.shutdown()
+
+
+# API calls and time per document with the summary and keywords of each section requested
+# separately and in one combined request
+def bench_extraction(args):
+    server = start_mock_server(args.latency)
+    use_mock_server(server)
+    import summarize
+    from prompt_wizard import get_nlp
+
+    get_nlp()
+    print("sections  calls(separate)  calls(combined)  separate(s)  combined(s)")
+    for count in args.counts:
+        text = make_text(count * 4800, seed=count)
+        results = []
+        for extraction in ("separate", "combined"):
+            server.calls = 0
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                summarize.handle_text(text, extraction=extraction)
+            results.append((server.calls, time.perf_counter() - start))
+        print("%8d  %15d  %15d  %11.2f  %11.2f" % (
+            count, results[0][0], results[1][0], results[0][1], results[1][1]))
+
+    server.shutdown()
+
+
+class MockPageHandler(BaseHTTPRequestHandler):
+    """
+    Serves /page/<n> as an HTML article after `latency` seconds, with an ETag so it can be
+    fetched again conditionally
+    """
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.calls += 1
+        time.sleep(self.latency)
+        etag = '"%s"' % zlib.crc32(self.path.encode())
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        seed = zlib.crc32(self.path.encode())
+        paragraphs = "".join("<p>%s</p>" % make_text(600, seed=seed + i) for i in range(20))
+        body = ("<html><head><title>Page %s</title></head><body><article><h1>Page %s</h1>%s"
+                "</article></body></html>" % (self.path, self.path, paragraphs)).encode()
+        with self.server.lock:
+            self.server.bytes_sent += len(body)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_page_server(latency: float) -> ThreadingHTTPServer:
+    handler = type("Handler", (MockPageHandler,), {"latency": latency})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.calls = 0
+    server.bytes_sent = 0
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# the url action before the fetch stage: download each page with a blocking request,
+# one after another, and parse it every time
+def legacy_fetch(urls):
+    import requests
+    from fetch import extract_text
+
+    return [extract_text(url, requests.get(url, timeout=20).text) for url in urls]
+
+
+# fetching a batch of pages one by one without a cache, then concurrently into the page
+# cache, again while it is fresh, and again revalidated with conditional requests
+def bench_fetch(args):
+    from fetch import PageCache, fetch_pages
+
+    server = start_page_server(args.latency)
+    urls = ["http://127.0.0.1:%d/page/%d" % (server.server_address[1], i) for i in range(args.pages)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache = PageCache(directory)
+        runs = [
+            ("serial, no cache", lambda: legacy_fetch(urls)),
+            ("concurrent, cold", lambda: fetch_pages(urls, cache, concurrency=args.concurrency)),
+            ("cache fresh", lambda: fetch_pages(urls, cache, concurrency=args.concurrency)),
+            ("revalidated", lambda: fetch_pages(urls, cache, concurrency=args.concurrency, fresh_seconds=0)),
+        ]
+        print("%d pages, %.0fms latency" % (args.pages, args.latency * 1000))
+        print("run               seconds  requests  KB sent")
+        # import newspaper and BeautifulSoup before timing
+        legacy_fetch(urls[:1])
+        for name, run in runs:
+            server.calls = 0
+            server.bytes_sent = 0
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                run()
+            seconds = time.perf_counter() - start
+            print("%-16s  %7.2f  %8d  %7.0f" % (name, seconds, server.calls, server.bytes_sent / 1024))
+
+    server.shutdown()
+
+
+# an SRT transcript of rolling captions: every cue shows the previous caption line again
+# above a new one, as auto-generated captions do
+def make_srt(cues: int, seed: int = 0) -> str:
+    words = make_text(cues * 60, seed=seed).split()
+    lines = [" ".join(words[i:i + 8]) for i in range(0, len(words), 8)][:cues]
+    blocks = []
+    for i, line in enumerate(lines):
+        start, end = i * 2, i * 2 + 2
+        timestamp = "00:%02d:%02d,000 --> 00:%02d:%02d,000" % (start // 60 % 60, start % 60, end // 60 % 60, end % 60)
+        text = line if i == 0 else lines[i - 1] + "\n" + line
+        blocks.append("%d\n%s\n%s\n" % (i + 1, timestamp, text))
+    return "\n".join(blocks)
+
+
+# API calls for SRT transcripts with and without the extractive stage: handle_text, where
+# repeated caption lines make extra sections, and one generate_summary over the whole
+# transcript, where the prompt is shortened locally before the API compresses it
+def bench_extractive(args):
+    server = start_mock_server(0.0, compression_ratio=args.ratio)
+    use_mock_server(server)
+    import summarize
+    from prompt_wizard import Config, get_nlp
+
+    get_nlp()
+
+    def calls(func, *func_args):
+        server.calls = 0
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            func(*func_args)
+        return server.calls, time.perf_counter() - start
+
+    def whole_document(text, extractive):
+        config = Config(max_tokens=summarize.TOKENS_PER_REQUEST, result_tokens=summarize.RESULT_TOKENS,
+                        openai_api_key="mock", final_suffix=summarize.FINAL_SUFFIX,
+                        final_prefix=summarize.FINAL_PREFIX, compression_prefix=summarize.COMPRESSION_PREFIX,
+                        temperature=summarize.TEMPERATURE, extractive=extractive)
+        summarize.generate_summary(config, text)
+
+    print("                     handle_text calls          whole document calls")
+    print("  cues   srt chars   before  after  (s before/after)   before  after  (s before/after)")
+    totals = [0, 0, 0, 0]
+    for cues in args.cues:
+        srt = make_srt(cues, seed=cues)
+        before, before_seconds = calls(summarize.handle_text, summarize.clean_text(srt, dedupe=False))
+        after, after_seconds = calls(summarize.handle_text, srt)
+        whole_before, whole_before_seconds = calls(whole_document, summarize.clean_text(srt, dedupe=False), False)
+        whole_after, whole_after_seconds = calls(whole_document, summarize.clean_text(srt, dedupe=True), True)
+        totals = [totals[0] + before, totals[1] + after, totals[2] + whole_before, totals[3] + whole_after]
+        print("%6d  %10d  %7d  %5d  (%5.2f/%5.2f)  %7d  %5d  (%5.2f/%5.2f)" % (
+            cues, len(srt), before, after, before_seconds, after_seconds,
+            whole_before, whole_after, whole_before_seconds, whole_after_seconds))
+    print("total               %7d  %5d                 %7d  %5d" % tuple(totals))
+
+    server.shutdown()
+
+
+def measure(func, *args):
+    tracemalloc.start()
+    start = time.process_time()
+    result = func(*args)
+    cpu = time.process_time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, cpu, peak
+
+
+# the pre-segmentation pipeline: parse the transcript to split sections, then re-parse
+# every section and every chunk it is subdivided into
+def legacy_segmentation(nlp, text, max_section_length, target_tokens):
+    def subdivide(chunk_text):
+        doc = nlp(chunk_text)
+        if len(doc) <= target_tokens:
+            return [chunk_text]
+        chunks = [" ".join(sent.text for sent in group) for group in
+                  legacy_groups(list(doc.sents), target_tokens)]
+        if len(chunks) == 1:
+            return chunks
+        return [piece for chunk in chunks for piece in subdivide(chunk)]
+
+    sections = []
+    current_section = ""
+    for sent in nlp(text).sents:
+        if len(current_section) + len(sent.text) < max_section_length:
+            current_section += sent.text + " "
+        else:
+            sections.append(current_section.strip())
+            current_section = sent.text + " "
+    sections.append(current_section.strip())
+
+    return [piece for section in sections for piece in subdivide(section)]
+
+
+def legacy_groups(sents, target_tokens):
+    groups, current, tokens = [], [], 0
+    for sent in sents:
+        if current and tokens + len(sent) > target_tokens:
+            groups.append(current)
+            current, tokens = [], 0
+        current.append(sent)
+        tokens += len(sent)
+    if current:
+        groups.append(current)
+    return groups
+
+
+def segmented(text, max_section_length, config):
+    from prompt_wizard import Snippet, join_sentences, segment
+    from summarize import split_sections
+
+    return [piece for section in split_sections(segment(text), max_section_length)
+            for piece in Snippet(join_sentences(section), compression=True, config=config,
+                                 sentences=section).subdivide()]
+
+
+def bench_segmentation(args):
+    os.environ.setdefault("OPENAI_API_KEY", "mock")
+    import spacy
+    from prompt_wizard import Config, get_nlp
+
+    # a transcript of sections that each get subdivided, like handle_text with a small target
+    config = Config(max_tokens=3500, result_tokens=400, final_prefix="", final_suffix="",
+                    compression_prefix="", openai_api_key="mock", temperature=0.0, target_tokens=300)
+    text = make_text(args.size)
+    get_nlp()
+
+    try:
+        legacy_nlp = spacy.load(args.model)
+    except OSError:
+        print("spaCy model %s is not installed, timing the legacy path with the sentencizer" % args.model)
+        legacy_nlp = spacy.blank("en")
+        legacy_nlp.add_pipe("sentencizer")
+    legacy_nlp.max_length = len(text) + 1
+
+    legacy, legacy_cpu, legacy_peak = measure(legacy_segmentation, legacy_nlp, text, 5000, config.target_tokens)
+    snippets, cpu, peak = measure(segmented, text, 5000, config)
+
+    print("text: %d chars, %d snippets (legacy: %d)" % (len(text), len(snippets), len(legacy)))
+    print("                cpu(s)  peak(MB)")
+    print("legacy        %8.2f  %8.1f" % (legacy_cpu, legacy_peak / 1e6))
+    print("parse once    %8.2f  %8.1f" % (cpu, peak / 1e6))
+    print("saved         %7.0f%%  %7.0f%%" % (100 * (1 - cpu / legacy_cpu), 100 * (1 - peak / legacy_peak)))
+
+
+def bench_budget(args):
+    server = start_mock_server(0.0)
+    use_mock_server(server)
+    import summarize
+    import tokens
+    from prompt_wizard import Config
+
+    # the summary prompt of handle_text, applied to the whole document at once
+    config = Config(max_tokens=summarize.TOKENS_PER_REQUEST, result_tokens=summarize.RESULT_TOKENS,
+                    openai_api_key="mock", final_suffix=summarize.FINAL_SUFFIX,
+                    final_prefix=summarize.FINAL_PREFIX, compression_prefix=summarize.COMPRESSION_PREFIX,
+                    temperature=summarize.TEMPERATURE)
+
+    def calls_per_document(text):
+        tokens._count_tokens_cached.cache_clear()
+        server.calls = 0
+        with contextlib.redirect_stdout(io.StringIO()):
+            summarize.generate_summary(config, text)
+        return server.calls
+
+    if tokens.get_encoding(tokens.COMPLETION_MODEL) is None:
+        print("the %s tokenizer is unavailable, both runs would use the estimate" % tokens.COMPLETION_MODEL)
+        return
+
+    print("  chars  tokens  calls(4 chars/token)  calls(tokenizer)")
+    totals = [0, 0]
+    for size in args.sizes:
+        text = make_text(size, seed=size)
+        counts = []
+        for estimate_only in (True, False):
+            tokens.ESTIMATE_ONLY = estimate_only
+            tokens.get_encoding.cache_clear()
+            counts.append(calls_per_document(text))
+        totals = [total + count for total, count in zip(totals, counts)]
+        print("%7d  %6d  %20d  %16d" % (len(text), tokens.count_tokens(text), counts[0], counts[1]))
+    print("  total  %6s  %20d  %16d" % ("", totals[0], totals[1]))
+
+    server.shutdown()
+
+
+def bench_prompt(args):
+    server = start_mock_server(0.0)
+    use_mock_server(server)
+    import summarize
+    from prompt_wizard import Config, Prompt, Snippet
+
+    config = Config(max_tokens=summarize.TOKENS_PER_REQUEST, result_tokens=summarize.RESULT_TOKENS,
+                    openai_api_key="mock", final_suffix=summarize.FINAL_SUFFIX,
+                    final_prefix=summarize.FINAL_PREFIX, compression_prefix=summarize.COMPRESSION_PREFIX,
+                    temperature=summarize.TEMPERATURE, target_tokens=250)
+
+    print("snippets  optimize(s)  ms/snippet  builds  size_updates  compressions")
+    for count in args.counts:
+        prompt = Prompt(config)
+        prompt.add(*Snippet(make_text(count * 1000, seed=count), compression=True, config=config).subdivide())
+        snippets = len(prompt.get_snippets())
+        with contextlib.redirect_stdout(io.StringIO()):
+            prompt.optimize()
+        stats = prompt.stats
+        print("%8d  %11.2f  %10.2f  %6d  %12d  %12d" % (
+            snippets, stats["optimize_seconds"], 1000 * stats["optimize_seconds"] / snippets,
+            stats["builds"], stats["size_updates"], stats["compressions"]))
+
+    server.shutdown()
+
+
+# Prompt.compress with the snippets compressed one after another, concurrently, and
+# concurrently but only as many as the budget needs
+def bench_compress(args):
+    server = start_mock_server(args.latency)
+    use_mock_server(server)
+    import summarize
+    from prompt_wizard import Config, Prompt, Snippet
+
+    modes = [("serial", 1, "all"), ("parallel", args.concurrency, "all"), ("budget", args.concurrency, "budget")]
+    # the parallel run must build the same prompt as the serial one
+    print("snippets  mode      calls  compress(s)  tokens before->after  same as serial")
+    for count in args.counts:
+        built = {}
+        for mode, concurrency, plan in modes:
+            config = Config(max_tokens=summarize.TOKENS_PER_REQUEST, result_tokens=summarize.RESULT_TOKENS,
+                            openai_api_key="mock", final_suffix=summarize.FINAL_SUFFIX,
+                            final_prefix=summarize.FINAL_PREFIX, compression_prefix=summarize.COMPRESSION_PREFIX,
+                            temperature=summarize.TEMPERATURE, target_tokens=250,
+                            compression_concurrency=concurrency, compression_plan=plan)
+            prompt = Prompt(config)
+            prompt.add(*Snippet(make_text(count * 1000, seed=count), compression=True, config=config).subdivide())
+            before = prompt.token_count()
+            server.calls = 0
+            with contextlib.redirect_stdout(io.StringIO()):
+                prompt.compress()
+            built[mode] = prompt.build()
+            print("%8d  %-8s  %5d  %11.2f  %10d->%-8d  %s" % (
+                len(prompt.get_snippets()), mode, server.calls, prompt.stats["compress_seconds"], before,
+                prompt.token_count(), "-" if plan == "budget" else "yes" if built[mode] == built["serial"] else "no"))
+
+    server.shutdown()
+
+
+# Prompt._optimize before snippets were packed: compress each snippet, then if the prompt
+# is still too long join everything, segment it again and compress the pieces
+def legacy_optimize(prompt):
+    from prompt_wizard import Snippet
+
+    if prompt.token_count() <= prompt._config.max_prompt_tokens:
+        return
+    prompt.compress()
+    if prompt.token_count() > prompt._config.max_prompt_tokens:
+        joined = Snippet("".join([str(s) for s in prompt.get_snippets()]), compression=True, config=prompt._config)
+        prompt._set_snippets(joined.subdivide())
+        prompt.compress()
+
+
+# API calls to fit a prompt with and without packing snippets, for a document subdivided
+# by generate_summary and for a prompt made of paragraphs of 50 to 400 tokens
+def bench_defragment(args):
+    server = start_mock_server(0.0, compression_ratio=args.ratio)
+    use_mock_server(server)
+    import summarize
+    from prompt_wizard import Config, Prompt, Snippet, get_nlp
+
+    config = Config(max_tokens=summarize.TOKENS_PER_REQUEST, result_tokens=summarize.RESULT_TOKENS,
+                    openai_api_key="mock", final_suffix=summarize.FINAL_SUFFIX,
+                    final_prefix=summarize.FINAL_PREFIX, compression_prefix=summarize.COMPRESSION_PREFIX,
+                    temperature=summarize.TEMPERATURE)
+    get_nlp()
+
+    def paragraphs(size):
+        rng = random.Random(size)
+        pieces, length = [], 0
+        while length < size:
+            piece = make_text(rng.randint(200, 1600), seed=rng.random())
+            pieces.append(Snippet(piece, compression=True, config=config))
+            length += len(piece)
+        return pieces
+
+    def run(workload, size):
+        server.calls = 0
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            if workload == "document":
+                summarize.generate_summary(config, make_text(size, seed=size))
+            else:
+                prompt = Prompt(config)
+                prompt.add(*paragraphs(size))
+                prompt.optimize()
+        return server.calls, time.perf_counter() - start
+
+    original = Prompt._optimize
+    print("workload     chars  calls(legacy)  calls(packed)  seconds(legacy)  seconds(packed)")
+    totals = [0, 0]
+    for workload in ("document", "paragraphs"):
+        for size in args.sizes:
+            Prompt._optimize = legacy_optimize
+            try:
+                legacy_calls, legacy_seconds = run(workload, size)
+            finally:
+                Prompt._optimize = original
+            calls, seconds = run(workload, size)
+            totals = [totals[0] + legacy_calls, totals[1] + calls]
+            print("%-10s  %7d  %13d  %13d  %15.2f  %15.2f" % (
+                workload, size, legacy_calls, calls, legacy_seconds, seconds))
+    print("total                %13d  %13d" % tuple(totals))
+
+    server.shutdown()
+
+
+def bench_chat(args):
+    server = start_mock_server(args.latency, args.token_latency)
+    use_mock_server(server)
+    from llm_client import get_client
+
+    client = get_client("mock")
+    messages = [{"role": "user", "content": "Hello"}]
+
+    start = time.perf_counter()
+    client.chat(messages, max_tokens=500, temperature=0.9)
+    blocking = time.perf_counter() - start
+
+    start = time.perf_counter()
+    first_token = None
+    pieces = []
+    for content in client.stream_chat(messages, max_tokens=500, temperature=0.9):
+        if first_token is None:
+            first_token = time.perf_counter() - start
+        pieces.append(content)
+    streamed = time.perf_counter() - start
+
+    print("reply: %r" % "".join(pieces))
+    print("blocking  time to reply:       %6.3fs" % blocking)
+    print("streaming time to first token: %6.3fs (full reply %.3fs)" % (first_token, streamed))
+
+    server.shutdown()
+
+
+# the old history truncation: re-sum every message on every turn and pop from the front of a list
+def legacy_truncate(history, max_chars):
+    while sum(len(message["content"]) for message in history) > max_chars and len(history) > 1:
+        history.pop(0)
+
+
+def bench_history(args):
+    import tempfile
+    from conversations import ConversationStore, SystemPrompt
+
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as file:
+        file.write("You are a helpful assistant.")
+    store = ConversationStore(SystemPrompt(file.name), db_path=None)
+    conversation = store.get("benchmark")
+    history = [{"role": "system", "content": "You are a helpful assistant."}]
+    random.seed(0)
+    turns = [(" ".join(random.choices(WORDS, k=random.randint(5, 60))),
+              " ".join(random.choices(WORDS, k=random.randint(20, 200)))) for _ in range(100)]
+
+    # load the tokenizer before timing
+    conversation.token_count()
+
+    print("turns  messages  us/turn  legacy us/turn")
+    elapsed = legacy_elapsed = 0.0
+    interval_start, report_at = 0, 10
+    for turn in range(1, args.turns + 1):
+        prompt, reply = turns[turn % len(turns)]
+
+        start = time.perf_counter()
+        conversation.append("user", prompt)
+        conversation.append("assistant", reply)
+        conversation.truncate(args.max_tokens)
+        conversation.messages()
+        elapsed += time.perf_counter() - start
+
+        start = time.perf_counter()
+        history.append({"role": "user", "content": prompt})
+        history.append({"role": "assistant", "content": reply})
+        legacy_truncate(history, args.max_tokens * 4)
+        legacy_elapsed += time.perf_counter() - start
+
+        if turn == report_at or turn == args.turns:
+            count = turn - interval_start
+            print("%5d  %8d  %7.1f  %14.1f" % (turn, len(conversation), 1e6 * elapsed / count,
+                                               1e6 * legacy_elapsed / count))
+            elapsed = legacy_elapsed = 0.0
+            interval_start, report_at = turn, report_at * 10
+
+    os.unlink(file.name)
+
+
+# the peak resident memory of this process, ru_maxrss would include the parent's from before exec
+def peak_rss_mb() -> float:
+    with open("/proc/self/status") as file:
+        for line in file:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# open a vector store and time queries against it, run in a fresh process so the peak
+# RSS is that of the store alone
+def measure_vector_store(kind: str, path: str, dim: int, queries: int, top_k: int) -> dict:
+    os.environ.setdefault("OPENAI_API_KEY", "mock")
+    import numpy as np
+    from llama_index import GPTSimpleVectorIndex
+    from llama_index.vector_stores.types import VectorStoreQuery
+    from vector_store import LocalVectorStore
+
+    vectors = np.random.default_rng(1).standard_normal((queries, dim), dtype=np.float32)
+    start = time.perf_counter()
+    if kind == "legacy":
+        index = GPTSimpleVectorIndex.load_from_disk(path)
+
+        def search(vector):
+            return index._vector_store.query(VectorStoreQuery(query_embedding=vector.tolist(), similarity_top_k=top_k))
+    else:
+        store = LocalVectorStore(path, backend=kind)
+
+        def search(vector):
+            return store.search_vector(vector, top_k)
+    load = time.perf_counter() - start
+
+    latencies = []
+    for vector in vectors:
+        start = time.perf_counter()
+        search(vector)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return {"load_seconds": load, "query_p50_ms": 1000 * statistics.median(latencies),
+            "query_p95_ms": 1000 * latencies[int(0.95 * (len(latencies) - 1))],
+            "peak_rss_mb": peak_rss_mb()}
+
+
+def build_vector_stores(directory: str, count: int, dim: int, backends, legacy: bool) -> dict:
+    import numpy as np
+    import vector_store
+    from vector_store import LocalVectorStore
+
+    rng = np.random.default_rng(0)
+    paths = {}
+    base = os.path.join(directory, "base")
+    store = LocalVectorStore(base, backend="numpy")
+    for start in range(0, count, 10000):
+        end = min(start + 10000, count)
+        store.add(["document %d %s" % (i, " ".join(rng.choice(WORDS, 20))) for i in range(start, end)],
+                  ["doc_%d" % i for i in range(start, end)], rng.standard_normal((end - start, dim), dtype=np.float32))
+
+    if legacy:
+        from llama_index import GPTSimpleVectorIndex
+        from llama_index.data_structs.node_v2 import DocumentRelationship, Node
+        rows = store._db.execute("SELECT row, doc_id, text FROM nodes ORDER BY row")
+        nodes = [Node(text=text, embedding=store._embeddings[row].tolist(),
+                      relationships={DocumentRelationship.SOURCE: doc_id}) for row, doc_id, text in rows]
+        path = os.path.join(directory, "index.json")
+        vector_store.save_index(GPTSimpleVectorIndex(nodes=nodes), path)
+        paths["legacy"] = path
+    store.close()
+
+    for backend in backends:
+        path = os.path.join(directory, backend)
+        os.makedirs(path)
+        os.link(os.path.join(base, "embeddings.f32"), os.path.join(path, "embeddings.f32"))
+        shutil.copy(os.path.join(base, "metadata.sqlite"), os.path.join(path, "metadata.sqlite"))
+        start = time.perf_counter()
+        # opening builds the graph from the embeddings, closing saves it
+        LocalVectorStore(path, backend=backend).close()
+        print("  built %s graph of %d in %.1fs" % (backend, count, time.perf_counter() - start))
+        paths[backend] = path
+    return paths
+
+
+def bench_vectors(args):
+    from vector_store import faiss, hnswlib
+
+    os.environ.setdefault("OPENAI_API_KEY", "mock")
+    backends = ["numpy"] + [name for name, module in (("hnswlib", hnswlib), ("faiss", faiss)) if module is not None]
+    # the stores are measured in fresh processes, not forks of this one
+    context = multiprocessing.get_context("spawn")
+    results = []
+
+    print("documents  store    load(s)  p50(ms)  p95(ms)  peak RSS(MB)")
+    for count in args.counts:
+        with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+            with contextlib.redirect_stdout(io.StringIO()) as log:
+                paths = build_vector_stores(directory, count, args.dim, backends, count <= args.legacy_max)
+            print(log.getvalue(), end="")
+            for kind, path in paths.items():
+                with context.Pool(1) as pool:
+                    result = pool.apply(measure_vector_store, (kind, path, args.dim, args.queries, args.top_k))
+                print("%9d  %-7s  %7.2f  %7.2f  %7.2f  %12.0f" % (
+                    count, kind, result["load_seconds"], result["query_p50_ms"], result["query_p95_ms"],
+                    result["peak_rss_mb"]))
+                results.append(dict(result, documents=count, store=kind))
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+# run in a fresh interpreter: import the app, then time its first responses. "eager" loads
+# the index and the NLP pipeline before serving, like the app did before it loaded them lazily
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter() - start
+if sys.argv[1] == "eager":
+    app.vector_store.get()
+    app.nlp.get()
+client = app.app.test_client()
+client.get("/")
+first_page = time.perf_counter() - start
+client.post("/message", data={"input": "hello", "action": "general"})
+first_chat = time.perf_counter() - start
+while client.get("/ready").status_code != 200:
+    time.sleep(0.01)
+ready = time.perf_counter() - start
+with open(sys.argv[2], "w") as file:
+    json.dump({"import": imported, "first_page": first_page, "first_chat": first_chat, "ready": ready}, file)
+"""
+
+
+def bench_startup(args):
+    server = start_mock_server(0.0)
+    use_mock_server(server)
+    repo = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=repo, WARM_UP="1", INDEX_FLUSH_INTERVAL="60")
+
+    with tempfile.TemporaryDirectory() as directory:
+        shutil.copy(os.path.join(repo, "system.txt"), directory)
+        os.makedirs(os.path.join(directory, "data"))
+        for i in range(args.documents):
+            with open(os.path.join(directory, "data", "%d.txt" % i), "w") as file:
+                file.write(make_text(2000, seed=i))
+
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            from vector_store import open_vector_store
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                open_vector_store("simple")
+            print("built index.json of %d documents in %.1fs (%.1f MB)" % (
+                args.documents, time.perf_counter() - start, os.path.getsize("index.json") / 1e6))
+        finally:
+            os.chdir(cwd)
+
+        print("startup  import(s)  first page(s)  first chat(s)  ready(s)")
+        for mode in ("eager", "lazy"):
+            runs = []
+            for _ in range(args.runs):
+                result_path = os.path.join(directory, "startup.json")
+                subprocess.run([sys.executable, "-c", STARTUP_SCRIPT, mode, result_path], cwd=directory, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+                with open(result_path) as file:
+                    runs.append(json.load(file))
+            result = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+            print("%-7s  %9.2f  %13.2f  %13.2f  %8.2f" % (
+                mode, result["import"], result["first_page"], result["first_chat"], result["ready"]))
+
+    server.shutdown()
+
+
+# bulk ingestion throughput against the number of batches embedded at once, with the
+# mock API's latency standing in for the embeddings endpoint
+def bench_ingest(args):
+    from ingest import ingest_directory
+    from vector_store import LocalVectorStore
+
+    server = start_mock_server(args.latency)
+    use_mock_server(server)
+
+    with tempfile.TemporaryDirectory() as directory:
+        data_dir = os.path.join(directory, "data")
+        os.makedirs(data_dir)
+        # every tenth file repeats another's content
+        for i in range(args.files):
+            with open(os.path.join(data_dir, "%d.txt" % i), "w") as file:
+                file.write(make_text(1500, seed=i - i % 10 if i % 10 == 9 else i))
+
+        print("concurrency  indexed  duplicate  seconds  files/s  re-run(s)")
+        for concurrency in args.concurrency:
+            store_dir = os.path.join(directory, "vectors-%d" % concurrency)
+            manifest = os.path.join(directory, "manifest-%d.json" % concurrency)
+            store = LocalVectorStore(store_dir, backend="numpy")
+            with contextlib.redirect_stdout(io.StringIO()):
+                stats = ingest_directory(store, data_dir, manifest, batch_size=args.batch_size,
+                                         concurrency=concurrency)
+                rerun = ingest_directory(store, data_dir, manifest, batch_size=args.batch_size,
+                                         concurrency=concurrency)
+            store.close()
+            print("%11d  %7d  %9d  %7.2f  %7.1f  %9.3f" % (
+                concurrency, stats["indexed"], stats["duplicate"], stats["seconds"],
+                stats["indexed"] / stats["seconds"], rerun["seconds"]))
+
+    server.shutdown()
+
+# the fixture corpora of the suite, made from fixed seeds so every run and every machine
+# sees the same text: a short chat, a rolling-caption SRT transcript of about srt_words
+# words and a long article
+def make_fixtures(srt_words: int = 50_000, article_words: int = 10_000, chat_turns: int = 20) -> dict:
+    rng = random.Random(0)
+    chat = [" ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 20))).capitalize() + "?"
+            for _ in range(chat_turns)]
+    # each cue after the first shows 16 words, half of them new
+    return {"chat": chat, "srt": make_srt(srt_words // 16, seed=1), "article": make_text(article_words * 6, seed=2)}
+
+
+# time run over rounds, each after an untimed setup, and summarize the times the way
+# pytest-benchmark does, with the mock API calls and failures of a round
+def run_scenario(name: str, group: str, server: ThreadingHTTPServer, rounds: int,
+                 run: Callable, setup: Optional[Callable] = None, operations: int = 1) -> dict:
+    times: List[float] = []
+    calls = errors = 0
+    for _ in range(rounds):
+        with contextlib.redirect_stdout(io.StringIO()):
+            state = setup() if setup is not None else None
+            calls_before, errors_before = server.calls, server.errors
+            start = time.perf_counter()
+            run(state)
+            times.append(time.perf_counter() - start)
+        calls += server.calls - calls_before
+        errors += server.errors - errors_before
+
+    mean = statistics.mean(times)
+    return {
+        "name": name,
+        "group": group,
+        "stats": {"rounds": rounds, "min": min(times), "max": max(times), "mean": mean,
+                  "median": statistics.median(times), "stddev": statistics.stdev(times) if rounds > 1 else 0.0,
+                  "ops": 1 / mean, "data": times},
+        "extra": {"operations": operations, "operations_per_second": operations / mean,
+                  "api_calls": calls / rounds, "api_errors": errors / rounds},
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        result = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+
+# print the change of each scenario's mean against a baseline results file and return
+# the scenarios that got slower by more than threshold
+def compare_results(baseline_path: str, results: dict, threshold: float) -> List[str]:
+    with open(baseline_path) as file:
+        baseline = {benchmark["name"]: benchmark for benchmark in json.load(file)["benchmarks"]}
+
+    regressions = []
+    print("scenario             baseline(s)   mean(s)   change")
+    for benchmark in results["benchmarks"]:
+        old = baseline.get(benchmark["name"])
+        if old is None:
+            print("%-19s  %11s  %8.3f  %7s" % (benchmark["name"], "-", benchmark["stats"]["mean"], "new"))
+            continue
+        change = benchmark["stats"]["mean"] / old["stats"]["mean"] - 1
+        slower = change > threshold
+        if slower:
+            regressions.append(benchmark["name"])
+        print("%-19s  %11.3f  %8.3f  %+6.1f%%%s" % (benchmark["name"], old["stats"]["mean"],
+                                                   benchmark["stats"]["mean"], 100 * change,
+                                                   "  slower" if slower else ""))
+    return regressions
+
+
+SUITE_SCENARIOS = ["summarize_srt", "summarize_article", "fetch_pages", "optimize_article", "index_insert",
+                   "index_query", "message_chat", "message_stream"]
+
+
+# every path that talks to the API, end to end against the mock servers, with the results
+# written as JSON to compare later runs against
+def bench_suite(args):
+    server = start_mock_server(args.latency, args.token_latency, compression_ratio=args.ratio,
+                               error_rate=args.error_rate)
+    use_mock_server(server)
+    page_server = start_page_server(args.latency)
+    repo = os.path.dirname(os.path.abspath(__file__))
+    fixtures = make_fixtures()
+    scenarios = set(args.scenarios)
+
+    with tempfile.TemporaryDirectory() as directory:
+        shutil.copy(os.path.join(repo, "system.txt"), directory)
+        cwd = os.getcwd()
+        # the app keeps its conversations, data and index in the working directory
+        os.chdir(directory)
+        # the index is loaded before timing and nothing is saved to it while the suite runs
+        os.environ["WARM_UP"] = "0"
+        os.environ["INDEX_BATCH_SIZE"] = "1000000"
+        os.environ["INDEX_FLUSH_INTERVAL"] = "3600"
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                import app
+                import summarize
+                from fetch import PageCache, fetch_pages
+                from llama_index import Document
+                from prompt_wizard import Config, Prompt, Snippet, get_nlp
+                from vector_store import LocalVectorStore
+
+                # load the index (so chat retrieves notes from it) and import newspaper,
+                # BeautifulSoup and spaCy before timing
+                app.vector_store.get()
+                get_nlp()
+                fetch_pages(["http://127.0.0.1:%d/page/warm-up" % page_server.server_address[1]],
+                            PageCache(os.path.join(directory, "warm-up")))
+            client = app.app.test_client()
+            config = Config(max_tokens=summarize.TOKENS_PER_REQUEST, result_tokens=summarize.RESULT_TOKENS,
+                            openai_api_key="mock", final_suffix=summarize.FINAL_SUFFIX,
+                            final_prefix=summarize.FINAL_PREFIX, compression_prefix=summarize.COMPRESSION_PREFIX,
+                            temperature=summarize.TEMPERATURE)
+            urls = ["http://127.0.0.1:%d/page/%d" % (page_server.server_address[1], i) for i in range(args.pages)]
+            documents = [make_text(1500, seed=i) for i in range(args.documents)]
+            stores = []
+
+            def new_prompt():
+                prompt = Prompt(config)
+                prompt.add(*Snippet(fixtures["article"], compression=True, config=config).subdivide())
+                return prompt
+
+            def new_store():
+                store = LocalVectorStore(tempfile.mkdtemp(dir=directory), backend="numpy")
+                stores.append(store)
+                return store
+
+            def insert(store):
+                store.insert([Document(text) for text in documents])
+                store.save()
+
+            def query_store():
+                if not any(len(store) for store in stores):
+                    insert(new_store())
+                return next(store for store in stores if len(store))
+
+            def chat(_):
+                for question in fixtures["chat"]:
+                    client.post("/message", data={"input": question, "action": "general"}).get_json()
+
+            def stream(_):
+                for question in fixtures["chat"]:
+                    client.post("/message/stream", data={"input": question}).get_data()
+
+            runs = [
+                ("summarize_srt", "summarize", lambda _: summarize.handle_text(fixtures["srt"]), None, 1),
+                ("summarize_article", "summarize", lambda _: summarize.handle_text(fixtures["article"]), None, 1),
+                ("fetch_pages", "url", lambda cache: fetch_pages(urls, cache),
+                 lambda: PageCache(tempfile.mkdtemp(dir=directory)), len(urls)),
+                ("optimize_article", "prompt", lambda prompt: prompt.optimize(), new_prompt, 1),
+                ("index_insert", "index", insert, new_store, len(documents)),
+                ("index_query", "index", lambda store: [store.search(question, 4) for question in fixtures["chat"]],
+                 query_store, len(fixtures["chat"])),
+                ("message_chat", "message", chat, None, len(fixtures["chat"])),
+                ("message_stream", "message", stream, None, len(fixtures["chat"])),
+            ]
+
+            print("%d rounds, %.0fms latency, %.0f%% errors" % (args.rounds, args.latency * 1000,
+                                                               args.error_rate * 100))
+            print("scenario             mean(s)  stddev(s)   ops/s  calls  errors")
+            benchmarks = []
+            for name, group, run, setup, operations in runs:
+                if name not in scenarios:
+                    continue
+                benchmark = run_scenario(name, group, server, args.rounds, run, setup, operations)
+                benchmarks.append(benchmark)
+                print("%-19s  %7.3f  %9.3f  %6.1f  %5.0f  %6.0f" % (
+                    name, benchmark["stats"]["mean"], benchmark["stats"]["stddev"],
+                    benchmark["extra"]["operations_per_second"], benchmark["extra"]["api_calls"],
+                    benchmark["extra"]["api_errors"]))
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                for store in stores:
+                    store.close()
+                app.index_writer.close()
+        finally:
+            os.chdir(cwd)
+
+    results = {
+        "machine_info": {"python": platform.python_version(), "platform": platform.platform(),
+                         "cpu_count": os.cpu_count()},
+        "commit": git_commit(),
+        "datetime": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": {"rounds": args.rounds, "latency": args.latency, "token_latency": args.token_latency,
+                   "ratio": args.ratio, "error_rate": args.error_rate, "pages": args.pages,
+                   "documents": args.documents},
+        "benchmarks": benchmarks,
+    }
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print("results written to %s" % args.output)
+
+    server.shutdown()
+    page_server.shutdown()
+
+    if args.compare:
+        regressions = compare_results(args.compare, results, args.threshold)
+        if regressions:
+            raise SystemExit("slower than the baseline: %s" % ", ".join(regressions))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    sections = subparsers.add_parser("sections", help="handle_text wall-clock time against section count")
+    sections.add_argument("--latency", type=float, default=0.05, help="mock API latency per request in seconds")
+    sections.add_argument("--concurrency", type=int, default=8)
+    sections.add_argument("--counts", type=int, nargs="+", default=[1, 4, 16, 32])
+    sections.set_defaults(func=bench_sections)
+
+    extraction = subparsers.add_parser("extraction", help="calls per document, separate and combined extraction")
+    extraction.add_argument("--latency", type=float, default=0.05, help="mock API latency per request in seconds")
+    extraction.add_argument("--counts", type=int, nargs="+", default=[1, 4, 16])
+    extraction.set_defaults(func=bench_extraction)
+
+    fetch = subparsers.add_parser("fetch", help="fetching pages serially, concurrently and from the page cache")
+    fetch.add_argument("--pages", type=int, default=32)
+    fetch.add_argument("--latency", type=float, default=0.2, help="mock page server latency in seconds")
+    fetch.add_argument("--concurrency", type=int, default=8)
+    fetch.set_defaults(func=bench_fetch)
+
+    extractive = subparsers.add_parser("extractive", help="API calls for SRT transcripts, with and without the "
+                                                          "extractive stage")
+    extractive.add_argument("--cues", type=int, nargs="+", default=[200, 1000, 4000])
+    extractive.add_argument("--ratio", type=float, default=0.3, help="how much the mock API compresses text")
+    extractive.set_defaults(func=bench_extractive)
+
+    segmentation = subparsers.add_parser("segmentation", help="CPU time and peak memory of sentence splitting")
+    segmentation.add_argument("--size", type=int, default=1_000_000, help="transcript size in characters")
+    segmentation.add_argument("--model", default="en_core_web_sm", help="spaCy model of the legacy pipeline")
+    segmentation.set_defaults(func=bench_segmentation)
+
+    budget = subparsers.add_parser("budget", help="API calls per document, token estimate against tokenizer")
+    budget.add_argument("--sizes", type=int, nargs="+", default=[8000, 12000, 14000, 16000, 24000, 48000],
+                        help="document sizes in characters")
+    budget.set_defaults(func=bench_budget)
+
+    prompt = subparsers.add_parser("prompt", help="Prompt.optimize time and operations against snippet count")
+    prompt.add_argument("--counts", type=int, nargs="+", default=[100, 200, 400, 800, 1600],
+                        help="approximate snippet counts")
+    prompt.set_defaults(func=bench_prompt)
+
+    compress = subparsers.add_parser("compress", help="Prompt.compress calls and time, serial, parallel and budget")
+    compress.add_argument("--latency", type=float, default=0.05, help="mock API latency per request in seconds")
+    compress.add_argument("--concurrency", type=int, default=4)
+    compress.add_argument("--counts", type=int, nargs="+", default=[4, 16, 64])
+    compress.set_defaults(func=bench_compress)
+
+    defragment = subparsers.add_parser("defragment", help="API calls to fit a prompt, with and without packing")
+    defragment.add_argument("--sizes", type=int, nargs="+", default=[20000, 50000, 100000, 200000])
+    defragment.add_argument("--ratio", type=float, default=0.3, help="how much the mock API compresses text")
+    defragment.set_defaults(func=bench_defragment)
+
+    chat = subparsers.add_parser("chat", help="time to first token, streaming against blocking chat")
+    chat.add_argument("--latency", type=float, default=0.3, help="mock API latency before the reply starts")
+    chat.add_argument("--token-latency", type=float, default=0.05, help="mock API delay between streamed words")
+    chat.set_defaults(func=bench_chat)
+
+    history = subparsers.add_parser("history", help="per-turn cost of keeping a chat history in its token budget")
+    history.add_argument("--turns", type=int, default=10000)
+    history.add_argument("--max-tokens", type=int, default=3500, help="history token budget")
+    history.set_defaults(func=bench_history)
+
+    vectors = subparsers.add_parser("vectors", help="vector store load time, query latency and memory")
+    vectors.add_argument("--counts", type=int, nargs="+", default=[10000, 100000, 1000000], help="document counts")
+    vectors.add_argument("--dim", type=int, default=384, help="embedding dimensions, ada-002 has 1536")
+    vectors.add_argument("--queries", type=int, default=100)
+    vectors.add_argument("--top-k", type=int, default=4)
+    vectors.add_argument("--legacy-max", type=int, default=10000,
+                         help="largest count to also measure as an index.json, it grows to gigabytes")
+    vectors.add_argument("--dir", default=None, help="where to build the stores, default the temp directory")
+    vectors.add_argument("--json", default=None, help="also write the results to this file")
+    vectors.set_defaults(func=bench_vectors)
+
+    startup = subparsers.add_parser("startup", help="time from importing the app to its first responses")
+    startup.add_argument("--documents", type=int, default=1000, help="documents in the index")
+    startup.add_argument("--runs", type=int, default=3, help="runs per mode, the median is shown")
+    startup.set_defaults(func=bench_startup)
+
+    ingest = subparsers.add_parser("ingest", help="bulk ingestion throughput against concurrency")
+    ingest.add_argument("--files", type=int, default=1000)
+    ingest.add_argument("--latency", type=float, default=0.05, help="mock API latency per request in seconds")
+    ingest.add_argument("--batch-size", type=int, default=16)
+    ingest.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8])
+    ingest.set_defaults(func=bench_ingest)
+
+    suite = subparsers.add_parser("suite", help="every scenario end to end, results written as JSON")
+    suite.add_argument("--rounds", type=int, default=3, help="timed runs of each scenario")
+    suite.add_argument("--latency", type=float, default=0.02, help="mock API and page server latency in seconds")
+    suite.add_argument("--token-latency", type=float, default=0.0, help="mock API delay between streamed words")
+    suite.add_argument("--ratio", type=float, default=0.3, help="how much the mock API compresses text")
+    suite.add_argument("--error-rate", type=float, default=0.0, help="share of mock API requests that fail")
+    suite.add_argument("--pages", type=int, default=8, help="pages fetched by fetch_pages")
+    suite.add_argument("--documents", type=int, default=100, help="documents inserted by index_insert")
+    suite.add_argument("--scenarios", nargs="+", choices=SUITE_SCENARIOS, default=SUITE_SCENARIOS)
+    suite.add_argument("--output", default="benchmark_results.json")
+    suite.add_argument("--compare", default=None, help="a results file to compare against")
+    suite.add_argument("--threshold", type=float, default=0.1,
+                       help="with --compare, exit with an error if a mean is this much slower")
+    suite.set_defaults(func=bench_suite)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
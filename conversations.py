@@ -0,0 +1,386 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Callable, Deque, Iterator, List, Optional, Tuple
+
+from tokens import count_message_tokens
+
+# conversations kept in memory, the least recently used are dropped beyond this
+CONVERSATION_CACHE_SIZE = int(os.getenv("CONVERSATION_CACHE_SIZE", "1000"))
+# set to a SQLite file to keep conversations across restarts and share them between processes
+CONVERSATION_DB = os.getenv("CONVERSATION_DB")
+# evicted turns are folded into the summary once they add up to this many tokens
+FOLD_MIN_TOKENS = 1000
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+
+class SystemPrompt:
+    """
+    The system message shared by every conversation, re-read only when the file changes
+    :param path: the file holding the system message
+    """
+
+    def __init__(self, path: str = "system.txt"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._message = None
+        self._tokens = 0
+
+    def _reload(self):
+        # another process may have updated the file
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime != self._mtime:
+            with open(self.path, "r") as file:
+                self._message = {"role": "system", "content": file.read()}
+            self._tokens = count_message_tokens(self._message)
+            self._mtime = mtime
+
+    @property
+    def message(self) -> dict:
+        with self._lock:
+            self._reload()
+            return self._message
+
+    @property
+    def tokens(self) -> int:
+        with self._lock:
+            self._reload()
+            return self._tokens
+
+    @property
+    def content(self) -> str:
+        return self.message["content"]
+
+    def update(self, content: str):
+        with self._lock:
+            with open(self.path, "w") as file:
+                file.write(content)
+            self._mtime = None
+
+
+class Conversation:
+    """
+    The messages of one session, as a window after the pinned system message (and the
+    summary of older turns, if they are being folded). The window keeps a running token
+    total so appending and evicting turns costs the same however long the session runs.
+    Turns are numbered from the start of the session, archived_turns marks how far the
+    session has been archived.
+    :param summarizer: when set, evicted turns are folded into a rolling summary with it
+                       in the background instead of being dropped
+    """
+
+    def __init__(self, session_id: str, system_prompt: SystemPrompt, store: "ConversationStore",
+                 messages: Optional[List[dict]] = None, version: int = 0,
+                 summarizer: Optional[Callable[[str], str]] = None):
+        self.session_id = session_id
+        self.system_prompt = system_prompt
+        # held for a read-modify-write of the conversation, e.g. a whole chat turn
+        self.lock = threading.RLock()
+        self.version = version
+        self._store = store
+        self._summarizer = summarizer
+        # held while the session is being archived, one archive at a time
+        self.archive_lock = threading.Lock()
+
+        self._messages: Deque[dict] = deque()
+        self._message_tokens: Deque[int] = deque()
+        self._tokens = 0
+        # turns appended since the session started or was reset, evicted ones included
+        self.turns = 0
+        self.archived_turns = 0
+
+        self.summary: Optional[str] = None
+        self._summary_message: Optional[dict] = None
+        self._summary_tokens = 0
+        self._evicted: List[dict] = []
+        self._evicted_tokens = 0
+        self._folding = False
+        # counts resets, a fold started before one is discarded
+        self._generation = 0
+
+        self._load(messages or [], None, len(messages or []), 0)
+
+    def _load(self, messages: List[dict], summary: Optional[str], turns: int, archived_turns: int):
+        self._messages.clear()
+        self._message_tokens.clear()
+        self._tokens = 0
+        for message in messages:
+            self._push(message)
+        self._set_summary(summary)
+        self.turns = turns
+        self.archived_turns = archived_turns
+
+    def _push(self, message: dict):
+        tokens = count_message_tokens(message)
+        self._messages.append(message)
+        self._message_tokens.append(tokens)
+        self._tokens += tokens
+
+    def _set_summary(self, summary: Optional[str]):
+        self.summary = summary
+        if summary:
+            self._summary_message = {"role": "system", "content": SUMMARY_PREFIX + summary}
+            self._summary_tokens = count_message_tokens(self._summary_message)
+        else:
+            self._summary_message = None
+            self._summary_tokens = 0
+
+    def __len__(self) -> int:
+        return len(self._messages) + 1
+
+    # the number of prompt tokens the messages cost, pinned messages included
+    def token_count(self) -> int:
+        return self.pinned_tokens() + self._tokens
+
+    # the messages to send to the chat API, starting with the system message
+    def messages(self) -> List[dict]:
+        with self.lock:
+            pinned = [self.system_prompt.message]
+            if self._summary_message is not None:
+                pinned.append(self._summary_message)
+            return pinned + list(self._messages)
+
+    def append(self, role: str, content: str):
+        message = {"role": role, "content": content}
+        with self.lock, self._store.writing(self) as db:
+            self._push(message)
+            self.turns += 1
+            self._store.save_append(db, self, message)
+
+    # the number of prompt tokens the system message and the summary cost
+    def pinned_tokens(self) -> int:
+        return self.system_prompt.tokens + self._summary_tokens
+
+    # evict the oldest turns until the conversation fits in max_tokens. The system message,
+    # the summary and the newest turn are never evicted, a chat request needs them
+    def truncate(self, max_tokens: int):
+        with self.lock:
+            if self.token_count() <= max_tokens:
+                return
+
+            with self._store.writing(self) as db:
+                dropped = 0
+                while len(self._messages) > 1 and self.token_count() > max_tokens:
+                    message = self._messages.popleft()
+                    tokens = self._message_tokens.popleft()
+                    self._tokens -= tokens
+                    dropped += 1
+                    if self._summarizer is not None:
+                        self._evicted.append(message)
+                        self._evicted_tokens += tokens
+                if dropped:
+                    self._store.save_drop(db, self, dropped)
+
+            if dropped:
+                self._maybe_fold()
+
+    # the turns still in the window that have not been archived, and the turn number
+    # to mark archived once they are
+    def unarchived(self) -> Tuple[List[dict], int]:
+        with self.lock:
+            skip = max(0, self.archived_turns - (self.turns - len(self._messages)))
+            return list(self._messages)[skip:], self.turns
+
+    # the prompt tokens the unarchived turns in the window cost
+    def unarchived_tokens(self) -> int:
+        with self.lock:
+            skip = max(0, self.archived_turns - (self.turns - len(self._messages)))
+            return sum(list(self._message_tokens)[skip:])
+
+    def mark_archived(self, turns: int):
+        with self.lock, self._store.writing(self) as db:
+            if turns > self.archived_turns:
+                self.archived_turns = turns
+                self._store.save_archived(db, self)
+
+    def reset(self):
+        with self.lock, self._store.writing(self) as db:
+            self._load([], None, 0, 0)
+            self._evicted = []
+            self._evicted_tokens = 0
+            self._generation += 1
+            self._store.save_reset(db, self)
+
+    # start folding the evicted turns into the summary once there are enough of them
+    def _maybe_fold(self):
+        if self._folding or self._evicted_tokens < FOLD_MIN_TOKENS:
+            return
+
+        evicted = self._evicted
+        self._evicted = []
+        self._evicted_tokens = 0
+        self._folding = True
+        threading.Thread(target=self._fold, args=(evicted, self.summary, self._generation, self.turns),
+                         daemon=True).start()
+
+    # the session was reset since it had this generation and turns, here or in another process
+    def _was_reset(self, generation: int, turns: int) -> bool:
+        return generation != self._generation or self.turns < turns
+
+    def _fold(self, evicted: List[dict], summary: Optional[str], generation: int, turns: int):
+        text = "\n".join(f"{message['role']}: {message['content']}" for message in evicted)
+        if summary:
+            text = summary + "\n\n" + text
+
+        try:
+            new_summary = self._summarizer(text)
+        except Exception as e:
+            print(f"error folding {len(evicted)} messages into the summary, retrying later: {e}")
+            with self.lock:
+                self._folding = False
+                if not self._was_reset(generation, turns):
+                    self._evicted = evicted + self._evicted
+                    self._evicted_tokens = sum(count_message_tokens(message) for message in self._evicted)
+            return
+
+        with self.lock:
+            self._folding = False
+            if self._was_reset(generation, turns):
+                return
+            with self._store.writing(self) as db:
+                # the database may hold a reset this process has not seen until now
+                if not self._was_reset(generation, turns):
+                    self._set_summary(new_summary)
+                    self._store.save_summary(db, self)
+
+
+class ConversationStore:
+    """
+    Conversations keyed by session id, safe to share between threads. With a database
+    the conversations are persisted, and every process serving the same database sees
+    the other processes' changes.
+    :param system_prompt: the system message every conversation starts with
+    :param max_sessions: the number of conversations kept in memory
+    :param db_path: the SQLite file to persist conversations in, if any
+    :param summarizer: folds evicted turns into a rolling summary instead of dropping them
+    """
+
+    def __init__(self, system_prompt: SystemPrompt, max_sessions: int = CONVERSATION_CACHE_SIZE,
+                 db_path: Optional[str] = CONVERSATION_DB, summarizer: Optional[Callable[[str], str]] = None):
+        self.system_prompt = system_prompt
+        self.max_sessions = max_sessions
+        self.summarizer = summarizer
+        self._sessions: "OrderedDict[str, Conversation]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.db_path = db_path
+
+        if db_path is not None:
+            with self._db() as db:
+                db.execute("CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, "
+                           "version INTEGER NOT NULL, updated REAL NOT NULL, summary TEXT, "
+                           "turns INTEGER NOT NULL DEFAULT 0, archived_turns INTEGER NOT NULL DEFAULT 0)")
+                db.execute("CREATE TABLE IF NOT EXISTS messages (session_id TEXT NOT NULL, seq INTEGER NOT NULL, "
+                           "role TEXT NOT NULL, content TEXT NOT NULL, PRIMARY KEY (session_id, seq))")
+                # columns added since the first version of the table
+                columns = [row[1] for row in db.execute("PRAGMA table_info(sessions)")]
+                for column, definition in (("summary", "TEXT"), ("turns", "INTEGER NOT NULL DEFAULT 0"),
+                                           ("archived_turns", "INTEGER NOT NULL DEFAULT 0")):
+                    if column not in columns:
+                        db.execute(f"ALTER TABLE sessions ADD COLUMN {column} {definition}")
+
+    # one connection per thread, sqlite3 connections must not be shared between threads
+    def _db(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.db_path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            self._local.db = db
+        return db
+
+    def get(self, session_id: str) -> Conversation:
+        with self._lock:
+            conversation = self._sessions.get(session_id)
+            if conversation is None:
+                conversation = Conversation(session_id, self.system_prompt, self, summarizer=self.summarizer)
+                self._sessions[session_id] = conversation
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            self._sessions.move_to_end(session_id)
+
+        if self.db_path is not None:
+            self._refresh(conversation)
+        return conversation
+
+    # reload a conversation another process has changed since it was cached
+    def _refresh(self, conversation: Conversation):
+        with conversation.lock:
+            db = self._db()
+            row = db.execute("SELECT version, summary, turns, archived_turns FROM sessions "
+                                     "WHERE session_id = ?", (conversation.session_id,)).fetchone()
+            version, summary, turns, archived_turns = row if row else (0, None, 0, 0)
+            if version == conversation.version:
+                return
+
+            rows = db.execute("SELECT role, content FROM messages WHERE session_id = ? ORDER BY seq",
+                                      (conversation.session_id,)).fetchall()
+            conversation._load([{"role": role, "content": content} for role, content in rows], summary,
+                               turns, archived_turns)
+            conversation.version = version
+
+    # a transaction changing a conversation, None without a database. The conversation is
+    # first brought up to date with the database, so the change applies to what other
+    # processes wrote, and its version is bumped
+    @contextmanager
+    def writing(self, conversation: Conversation) -> Iterator[Optional[sqlite3.Connection]]:
+        if self.db_path is None:
+            yield None
+            return
+
+        with conversation.lock:
+            db = self._db()
+            # take the write lock now, another process cannot change the session until commit
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                self._refresh(conversation)
+                db.execute("INSERT INTO sessions (session_id, version, updated) VALUES (?, 1, ?) "
+                           "ON CONFLICT(session_id) DO UPDATE SET version = version + 1, "
+                           "updated = excluded.updated", (conversation.session_id, time.time()))
+                yield db
+                version = db.execute("SELECT version FROM sessions WHERE session_id = ?",
+                                     (conversation.session_id,)).fetchone()[0]
+                db.commit()
+            except BaseException:
+                db.rollback()
+                # the conversation may be ahead of the database now, reload it on next use
+                conversation.version = -1
+                raise
+            conversation.version = version
+
+    def save_append(self, db: Optional[sqlite3.Connection], conversation: Conversation, message: dict):
+        if db is None:
+            return
+        db.execute("INSERT INTO messages (session_id, seq, role, content) "
+                   "SELECT ?, COALESCE(MAX(seq), -1) + 1, ?, ? FROM messages WHERE session_id = ?",
+                   (conversation.session_id, message["role"], message["content"], conversation.session_id))
+        db.execute("UPDATE sessions SET turns = turns + 1 WHERE session_id = ?", (conversation.session_id,))
+
+    def save_drop(self, db: Optional[sqlite3.Connection], conversation: Conversation, count: int):
+        if db is None:
+            return
+        db.execute("DELETE FROM messages WHERE session_id = ? AND seq IN "
+                   "(SELECT seq FROM messages WHERE session_id = ? ORDER BY seq LIMIT ?)",
+                   (conversation.session_id, conversation.session_id, count))
+
+    def save_reset(self, db: Optional[sqlite3.Connection], conversation: Conversation):
+        if db is None:
+            return
+        db.execute("DELETE FROM messages WHERE session_id = ?", (conversation.session_id,))
+        db.execute("UPDATE sessions SET summary = NULL, turns = 0, archived_turns = 0 WHERE session_id = ?",
+                   (conversation.session_id,))
+
+    def save_summary(self, db: Optional[sqlite3.Connection], conversation: Conversation):
+        if db is None:
+            return
+        db.execute("UPDATE sessions SET summary = ? WHERE session_id = ?",
+                   (conversation.summary, conversation.session_id))
+
+    def save_archived(self, db: Optional[sqlite3.Connection], conversation: Conversation):
+        if db is None:
+            return
+        db.execute("UPDATE sessions SET archived_turns = MAX(archived_turns, ?) WHERE session_id = ?",
+                   (conversation.archived_turns, conversation.session_id))
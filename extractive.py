@@ -0,0 +1,104 @@
+import re
+import zlib
+from typing import List, Sequence, TypeVar
+
+import numpy as np
+
+# dimensions of the hashed TF-IDF vectors
+EXTRACTIVE_FEATURES = 1024
+# a sentence or line at least this similar to one kept shortly before it is a repeat
+DUPLICATE_SIMILARITY = 0.9
+# how many kept sentences or lines back repeats are looked for
+DUPLICATE_WINDOW = 50
+# TextRank compares every pair of sentences, longer texts are scored by their similarity
+# to the text as a whole instead
+TEXTRANK_MAX_SENTENCES = 2000
+TEXTRANK_DAMPING = 0.85
+TEXTRANK_ITERATIONS = 30
+
+WORD_RE = re.compile(r"[a-z0-9']+")
+
+# anything with .text and .tokens, like prompt_wizard.Sentence
+S = TypeVar("S")
+
+
+# L2-normalized TF-IDF vectors of texts, one row each, words hashed into EXTRACTIVE_FEATURES
+def tfidf_vectors(texts: Sequence[str]) -> np.ndarray:
+    rows, columns = [], []
+    for i, text in enumerate(texts):
+        for word in WORD_RE.findall(text.lower()):
+            rows.append(i)
+            columns.append(zlib.crc32(word.encode()) % EXTRACTIVE_FEATURES)
+
+    counts = np.zeros((len(texts), EXTRACTIVE_FEATURES), dtype=np.float32)
+    np.add.at(counts, (rows, columns), 1.0)
+    document_frequency = np.count_nonzero(counts, axis=0)
+    idf = np.log((1 + len(texts)) / (1 + document_frequency)) + 1
+    vectors = np.log1p(counts) * idf.astype(np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+# which rows to keep: a row repeating one of the DUPLICATE_WINDOW rows kept before it is
+# dropped, rows without words are kept
+def repeat_mask(vectors: np.ndarray, threshold: float = DUPLICATE_SIMILARITY,
+                window: int = DUPLICATE_WINDOW) -> np.ndarray:
+    keep = np.ones(len(vectors), dtype=bool)
+    kept: List[int] = []
+    for i, vector in enumerate(vectors):
+        if not vector.any():
+            continue
+        recent = kept[-window:]
+        if recent and float(np.max(vectors[recent] @ vector)) >= threshold:
+            keep[i] = False
+        else:
+            kept.append(i)
+    return keep
+
+
+# how central each sentence is: TextRank over the cosine similarity graph
+def sentence_scores(vectors: np.ndarray) -> np.ndarray:
+    count = len(vectors)
+    if count > TEXTRANK_MAX_SENTENCES:
+        centroid = vectors.sum(axis=0)
+        return vectors @ (centroid / max(float(np.linalg.norm(centroid)), 1e-12))
+
+    similarity = np.clip(vectors @ vectors.T, 0.0, None)
+    np.fill_diagonal(similarity, 0.0)
+    totals = similarity.sum(axis=1, keepdims=True)
+    transition = np.divide(similarity, totals, out=np.zeros_like(similarity), where=totals > 0)
+
+    scores = np.full(count, 1.0 / count, dtype=np.float32)
+    for _ in range(TEXTRANK_ITERATIONS):
+        scores = (1 - TEXTRANK_DAMPING) / count + TEXTRANK_DAMPING * (transition.T @ scores)
+    return scores
+
+
+def dedupe_lines(lines: List[str]) -> List[str]:
+    if not lines:
+        return lines
+    keep = repeat_mask(tfidf_vectors(lines))
+    return [line for line, kept in zip(lines, keep) if kept]
+
+
+def dedupe_sentences(sentences: List[S]) -> List[S]:
+    if not sentences:
+        return sentences
+    keep = repeat_mask(tfidf_vectors([sentence.text for sentence in sentences]))
+    return [sentence for sentence, kept in zip(sentences, keep) if kept]
+
+
+# the highest scoring sentences that fit in max_tokens, in their original order
+def extract_sentences(sentences: List[S], max_tokens: int) -> List[S]:
+    if sum(sentence.tokens for sentence in sentences) <= max_tokens:
+        return sentences
+
+    scores = sentence_scores(tfidf_vectors([sentence.text for sentence in sentences]))
+    chosen = []
+    total = 0
+    # a stable sort, sentences scoring the same are taken in text order
+    for i in np.argsort(-scores, kind="stable"):
+        if total + sentences[i].tokens <= max_tokens:
+            chosen.append(i)
+            total += sentences[i].tokens
+    return [sentences[i] for i in sorted(chosen)]
@@ -0,0 +1,190 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+import uuid
+from typing import List, NamedTuple, Optional
+
+from metrics import PAGES_FETCHED, stage
+
+# fetched pages are kept here, with their validators and extracted text
+PAGE_CACHE_DIR = os.getenv("PAGE_CACHE_DIR", "pages")
+# a cached page younger than this is used without asking the server whether it changed
+PAGE_CACHE_FRESH_SECONDS = float(os.getenv("PAGE_CACHE_FRESH_SECONDS", "300"))
+# seconds a fetch may take in total, connecting and reading included
+FETCH_TIMEOUT = float(os.getenv("FETCH_TIMEOUT", "20"))
+# pages larger than this are not downloaded
+FETCH_MAX_BYTES = int(os.getenv("FETCH_MAX_BYTES", str(5 * 1024 * 1024)))
+# pages fetched at the same time
+FETCH_CONCURRENCY = int(os.getenv("FETCH_CONCURRENCY", "8"))
+USER_AGENT = ("Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) AppleWebKit/537.36 (KHTML, like Gecko) "
+              "Chrome/50.0.2661.102 Safari/537.36")
+
+
+class Page(NamedTuple):
+    url: str
+    # the extracted text, None when the page could not be fetched
+    text: Optional[str]
+    error: Optional[str] = None
+    # "fresh" when served from the cache without a request, "revalidated" after a 304,
+    # "downloaded" otherwise
+    source: Optional[str] = None
+
+
+# the fetch failed in a way worth reporting to the user
+class FetchError(Exception):
+    pass
+
+
+def url_to_filename(url):
+    new_string = url.replace("/", "-")
+    return hashlib.md5(new_string.encode()).hexdigest()+".md"
+
+
+# the readable text of an HTML page: the article text where newspaper finds one, the
+# text of the headings, paragraphs, code and description meta tags otherwise
+def extract_text(url: str, html: str) -> str:
+    # imported here, both take a while to import and most requests never fetch a page
+    from bs4 import BeautifulSoup
+    from newspaper import Article
+
+    try:
+        article = Article(url)
+        article.download(input_html=html)
+        article.parse()
+        if article.text.strip():
+            return article.text.strip()
+    except Exception as e:
+        print(f"error extracting the article of {url}, using the page text: {e}")
+
+    soup = BeautifulSoup(html, "html.parser")
+    lines = []
+    for element in soup.find_all(["title", "meta", "pre", "p", "h1", "h2", "h3", "h4", "h5", "h6"]):
+        if element.name == "meta":
+            if element.get("name") in ["description", "keywords", "author", "og:title", "og:description"]:
+                lines.append(element.get("content", "").strip())
+            continue
+        lines.append(element.get_text().strip())
+    return "\n".join(line for line in lines if line)
+
+
+class PageCache:
+    """
+    Fetched pages on disk, keyed by url_to_filename, with the ETag and Last-Modified
+    headers they were served with so they can be fetched again conditionally
+    :param directory: where the pages are kept
+    """
+
+    def __init__(self, directory: str = PAGE_CACHE_DIR):
+        self.directory = directory
+
+    def _path(self, url: str) -> str:
+        return os.path.join(self.directory, url_to_filename(url) + ".json")
+
+    def get(self, url: str) -> Optional[dict]:
+        try:
+            with open(self._path(url), "r") as file:
+                entry = json.load(file)
+        except (OSError, ValueError):
+            return None
+        # two urls with the same filename must not share a page
+        return entry if entry.get("url") == url else None
+
+    def set(self, url: str, text: str, etag: Optional[str], last_modified: Optional[str]):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(url)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump({"url": url, "text": text, "etag": etag, "last_modified": last_modified,
+                       "fetched": time.time()}, file)
+        os.replace(tmp_path, path)
+
+    def touch(self, url: str, entry: dict):
+        self.set(url, entry["text"], entry.get("etag"), entry.get("last_modified"))
+
+
+async def _read_limited(response, max_bytes: int) -> bytes:
+    length = response.headers.get("Content-Length")
+    if length is not None and length.isdigit() and int(length) > max_bytes:
+        raise FetchError(f"page is larger than {max_bytes} bytes")
+
+    body = bytearray()
+    async for chunk in response.content.iter_chunked(64 * 1024):
+        body.extend(chunk)
+        if len(body) > max_bytes:
+            raise FetchError(f"page is larger than {max_bytes} bytes")
+    return bytes(body)
+
+
+async def _fetch(session, url: str, cache: PageCache, fresh_seconds: float, max_bytes: int) -> Page:
+    import aiohttp
+
+    entry = cache.get(url)
+    if entry is not None and time.time() - entry.get("fetched", 0) < fresh_seconds:
+        return Page(url, entry["text"], source="fresh")
+
+    headers = {}
+    if entry is not None:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+    try:
+        async with session.get(url, headers=headers) as response:
+            if response.status == 304 and entry is not None:
+                cache.touch(url, entry)
+                return Page(url, entry["text"], source="revalidated")
+            if response.status != 200:
+                raise FetchError(f"{response.status} {response.reason}")
+            content_type = response.content_type or ""
+            if not (content_type.startswith("text/") or "html" in content_type or "xml" in content_type):
+                raise FetchError(f"unsupported content type {content_type}")
+
+            body = await _read_limited(response, max_bytes)
+            html = body.decode(response.get_encoding() if response.charset else "utf-8", errors="replace")
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+    except FetchError as e:
+        return Page(url, None, str(e))
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        return Page(url, None, f"{type(e).__name__}: {e}" if str(e) else type(e).__name__)
+
+    # parsing takes a while, the other fetches go on meanwhile
+    text = await asyncio.get_running_loop().run_in_executor(None, extract_text, url, html)
+    cache.set(url, text, etag, last_modified)
+    return Page(url, text, source="downloaded")
+
+
+async def fetch_pages_async(urls: List[str], cache: Optional[PageCache] = None,
+                            concurrency: int = FETCH_CONCURRENCY, timeout: float = FETCH_TIMEOUT,
+                            max_bytes: int = FETCH_MAX_BYTES,
+                            fresh_seconds: float = PAGE_CACHE_FRESH_SECONDS) -> List[Page]:
+    import aiohttp
+
+    cache = cache or PageCache()
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+
+    async with aiohttp.ClientSession(timeout=client_timeout, headers={"User-Agent": USER_AGENT}) as session:
+        async def fetch_one(url):
+            async with semaphore:
+                return await _fetch(session, url, cache, fresh_seconds, max_bytes)
+
+        pages = await asyncio.gather(*(fetch_one(url) for url in urls))
+
+    for page in pages:
+        PAGES_FETCHED.inc(source=page.source or "error")
+    return pages
+
+
+# fetch and extract the text of pages concurrently, in the order of urls. A page that
+# fails has its error set instead of its text, it does not fail the others
+def fetch_pages(urls: List[str], cache: Optional[PageCache] = None, **kwargs) -> List[Page]:
+    with stage("fetch"):
+        return asyncio.run(fetch_pages_async(urls, cache, **kwargs))
+
+
+def fetch_page(url: str, cache: Optional[PageCache] = None, **kwargs) -> Page:
+    return fetch_pages([url], cache, **kwargs)[0]
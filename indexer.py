@@ -0,0 +1,128 @@
+import atexit
+import hashlib
+import os
+import queue
+import threading
+import time
+from typing import List, NamedTuple, Optional
+
+from lazy import Lazy
+from metrics import stage
+
+# documents inserted (and embedded) together in one batch
+BATCH_SIZE = int(os.getenv("INDEX_BATCH_SIZE", "32"))
+# seconds a queued document may wait for others before its batch is inserted and saved
+FLUSH_INTERVAL = float(os.getenv("INDEX_FLUSH_INTERVAL", "5"))
+
+
+# the id of a piece of content, the same wherever and however often it is saved
+def content_id(content: str) -> str:
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class QueuedDocument(NamedTuple):
+    content: str
+    doc_id: str
+    # the session whose turn it is, None for a document every session shares
+    session: Optional[str] = None
+
+
+class IndexWriter:
+    """
+    Inserts documents into a vector store from a background thread, in batches, and
+    persists the store after each batch. A document whose id is queued or stored already
+    is not embedded again.
+    :param store: the VectorStore to insert into, loaded by the writer thread if it is not yet
+    :param batch_size: the most documents inserted at once
+    :param flush_interval: seconds to wait for a batch to fill before it is inserted
+    """
+
+    def __init__(self, store: Lazy, batch_size: int = BATCH_SIZE, flush_interval: float = FLUSH_INTERVAL):
+        self.store = store
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._queue: "queue.Queue" = queue.Queue()
+        self._pending: List[QueuedDocument] = []
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="index-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    # queue a document for insertion, returns immediately
+    def add(self, content: str, doc_id: str, session: Optional[str] = None):
+        if self._closed:
+            raise RuntimeError("index writer is closed")
+        self._queue.put(QueuedDocument(content, doc_id, session))
+
+    # insert and save everything queued so far
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    # flush the queue, stop the writer thread and close the store
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        if self.store.ready:
+            self.store.get().close()
+
+    def _run(self):
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False
+
+            if isinstance(item, QueuedDocument):
+                self._pending.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+                if len(self._pending) < self.batch_size:
+                    continue
+
+            self._write()
+            deadline = time.monotonic() + self.flush_interval if self._pending else None
+
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is None:
+                return
+
+    def _write(self):
+        if not self._pending:
+            return
+
+        # imported here, llama_index takes seconds to import and the app starts without it
+        from llama_index import Document
+
+        batch = self._pending
+        start = time.perf_counter()
+        try:
+            store = self.store.get()
+            documents = {}
+            sessions = {}
+            for item in batch:
+                if item.doc_id not in documents and item.doc_id not in store:
+                    documents[item.doc_id] = Document(item.content, doc_id=item.doc_id)
+                    if item.session is not None:
+                        sessions[item.doc_id] = item.session
+            if documents:
+                with stage("index_insert"):
+                    store.insert(list(documents.values()), sessions)
+                with stage("index_save"):
+                    store.save()
+        except Exception as e:
+            # keep the batch, it is retried on the next flush
+            print(f"error indexing {len(batch)} documents, retrying later: {e}")
+            return
+
+        self._pending = []
+        print(f"indexed {len(documents)} documents ({len(batch) - len(documents)} already indexed) "
+              f"in {time.perf_counter() - start:.2f}s")
@@ -0,0 +1,236 @@
+"""
+Index the files of the data directory: in parallel, once per unique content, resumable.
+
+The manifest records the size, mtime and content hash of every file indexed so far, so a
+re-run only reads new or changed files, and an interrupted run picks up where its last
+checkpoint left off.
+
+usage: python ingest.py [--data data] [--store simple|local] [--batch-size 64] [--concurrency 4]
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+INGEST_MANIFEST = "ingest_manifest.json"
+# documents inserted (and embedded) together
+INGEST_BATCH_SIZE = 64
+# batches being embedded at the same time
+INGEST_CONCURRENCY = 4
+# threads reading and hashing files
+INGEST_READ_WORKERS = 8
+# seconds between checkpoints, the store is saved and the manifest written at each
+INGEST_CHECKPOINT_SECONDS = 30.0
+
+
+class SourceFile(NamedTuple):
+    path: str
+    doc_id: str
+    size: int
+    mtime_ns: int
+    sha256: str
+    content: str
+
+
+def load_manifest(path: str) -> Dict[str, dict]:
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as file:
+        return json.load(file)["files"]
+
+
+def save_manifest(path: str, files: Dict[str, dict]):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as file:
+        json.dump({"files": files}, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+# the files under directory, hidden ones excluded, by path relative to it
+def list_files(directory: str) -> List[str]:
+    paths = []
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for name in sorted(files):
+            if not name.startswith("."):
+                paths.append(os.path.relpath(os.path.join(root, name), directory))
+    return paths
+
+
+def read_file(directory: str, path: str) -> SourceFile:
+    full_path = os.path.join(directory, path)
+    stat = os.stat(full_path)
+    with open(full_path, "rb") as file:
+        data = file.read()
+    # documents are identified by their content hash, as the app identifies the ones it
+    # saves (indexer.content_id), so files with the same name in different folders stay
+    # apart and files the app has indexed already are recognized
+    sha256 = hashlib.sha256(data).hexdigest()
+    return SourceFile(path, sha256, stat.st_size, stat.st_mtime_ns, sha256, data.decode("utf-8", errors="replace"))
+
+
+def ingest_directory(store, directory: str, manifest_path: str = INGEST_MANIFEST,
+                     batch_size: int = INGEST_BATCH_SIZE, concurrency: int = INGEST_CONCURRENCY,
+                     read_workers: int = INGEST_READ_WORKERS,
+                     checkpoint_seconds: float = INGEST_CHECKPOINT_SECONDS,
+                     progress: Optional[Callable[[dict], None]] = None) -> dict:
+    """
+    Insert the files of directory into store, skipping files the manifest has seen
+    unchanged, files whose content was already inserted, and documents already in the store
+    :param concurrency: the most batches embedded at the same time
+    :param progress: called with the stats after every batch
+    :return: the number of files found, unchanged, duplicate, already indexed, indexed and
+             failed, and the seconds taken
+    """
+    from llama_index import Document
+
+    manifest = load_manifest(manifest_path)
+    ingested_hashes = {entry["sha256"] for entry in manifest.values()}
+    stats = {"files": 0, "unchanged": 0, "duplicate": 0, "already_indexed": 0, "indexed": 0, "failed": 0,
+             "seconds": 0.0}
+    start = time.perf_counter()
+
+    changed = []
+    for path in list_files(directory):
+        stats["files"] += 1
+        entry = manifest.get(path)
+        stat = os.stat(os.path.join(directory, path))
+        if entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            stats["unchanged"] += 1
+        else:
+            changed.append(path)
+
+    # manifest entries of inserted batches, written at the next checkpoint after the store is saved
+    done: Dict[str, dict] = {}
+    last_checkpoint = time.monotonic()
+
+    def record(source: SourceFile):
+        done[source.path] = {"size": source.size, "mtime_ns": source.mtime_ns, "sha256": source.sha256}
+
+    def checkpoint():
+        nonlocal last_checkpoint
+        store.save()
+        manifest.update(done)
+        done.clear()
+        save_manifest(manifest_path, manifest)
+        last_checkpoint = time.monotonic()
+
+    def insert(batch: List[SourceFile]):
+        store.insert([Document(source.content, doc_id=source.doc_id) for source in batch])
+
+    in_flight = {}
+    # by content hash of a file not yet inserted, the files with the same content read since,
+    # recorded as duplicates only once the insert succeeds so a failed one retries them all
+    pending: Dict[str, List[SourceFile]] = {}
+
+    def collect(futures):
+        for future in futures:
+            batch = in_flight.pop(future)
+            duplicates = [duplicate for source in batch for duplicate in pending.pop(source.sha256)]
+            try:
+                future.result()
+            except Exception as e:
+                print(f"error indexing {len(batch) + len(duplicates)} files, "
+                      f"they are retried on the next run: {e}")
+                stats["failed"] += len(batch) + len(duplicates)
+                continue
+            for source in batch:
+                ingested_hashes.add(source.sha256)
+                record(source)
+            for duplicate in duplicates:
+                record(duplicate)
+            stats["indexed"] += len(batch)
+            stats["duplicate"] += len(duplicates)
+        stats["seconds"] = time.perf_counter() - start
+        if progress is not None:
+            progress(stats)
+        if time.monotonic() - last_checkpoint >= checkpoint_seconds:
+            checkpoint()
+
+    try:
+        with ThreadPoolExecutor(max_workers=read_workers) as readers, \
+                ThreadPoolExecutor(max_workers=concurrency) as writers:
+            batch: List[SourceFile] = []
+            # read ahead a few batches at a time, not the whole directory
+            chunk = batch_size * concurrency
+            for chunk_start in range(0, len(changed), chunk):
+                paths = changed[chunk_start:chunk_start + chunk]
+                for source in readers.map(lambda path: read_file(directory, path), paths):
+                    if source.sha256 in ingested_hashes:
+                        # the same content under another name, or a file touched but not changed
+                        stats["duplicate"] += 1
+                        record(source)
+                        continue
+                    if source.sha256 in pending:
+                        pending[source.sha256].append(source)
+                        continue
+                    if source.doc_id in store:
+                        ingested_hashes.add(source.sha256)
+                        stats["already_indexed"] += 1
+                        record(source)
+                        continue
+
+                    pending[source.sha256] = []
+                    batch.append(source)
+                    if len(batch) == batch_size:
+                        # bound the batches held in memory
+                        if len(in_flight) >= 2 * concurrency:
+                            completed, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                            collect(completed)
+                        in_flight[writers.submit(insert, batch)] = batch
+                        batch = []
+
+            if batch:
+                in_flight[writers.submit(insert, batch)] = batch
+            while in_flight:
+                completed, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(completed)
+    finally:
+        # also on Ctrl-C, so the next run resumes from here
+        checkpoint()
+
+    stats["seconds"] = time.perf_counter() - start
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data", default="data", help="the directory to index")
+    parser.add_argument("--store", default=None, help="simple or local, default VECTOR_STORE")
+    parser.add_argument("--manifest", default=INGEST_MANIFEST)
+    parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE)
+    parser.add_argument("--concurrency", type=int, default=INGEST_CONCURRENCY)
+    parser.add_argument("--read-workers", type=int, default=INGEST_READ_WORKERS)
+    parser.add_argument("--checkpoint-seconds", type=float, default=INGEST_CHECKPOINT_SECONDS)
+    args = parser.parse_args()
+
+    from vector_store import VECTOR_STORE, open_vector_store
+
+    store = open_vector_store(args.store or VECTOR_STORE, ingest_data=False)
+    last_report = 0.0
+
+    def report(stats: dict):
+        nonlocal last_report
+        if time.monotonic() - last_report >= 1:
+            last_report = time.monotonic()
+            print("indexed %d files, %d duplicate, %d already indexed, %d failed, %.1f files/s" % (
+                stats["indexed"], stats["duplicate"], stats["already_indexed"], stats["failed"],
+                stats["indexed"] / max(stats["seconds"], 1e-9)))
+
+    try:
+        stats = ingest_directory(store, args.data, args.manifest, args.batch_size, args.concurrency,
+                                 args.read_workers, args.checkpoint_seconds, report)
+    finally:
+        store.close()
+    print(json.dumps(stats))
+    if stats["failed"]:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+# jobs running at the same time, each job also fans out its own API requests
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", "2"))
+# jobs that may wait for a worker before new submissions are refused
+JOB_MAX_PENDING = int(os.getenv("JOB_MAX_PENDING", "16"))
+# finished jobs kept around for their results
+JOB_HISTORY = 100
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+# raised from a job's progress callback once the job has been cancelled
+class JobCancelled(Exception):
+    pass
+
+
+# raised when too many jobs are waiting for a worker
+class JobQueueFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, action: str):
+        self.id = uuid.uuid4().hex
+        self.action = action
+        self.status = QUEUED
+        self.step = "Queued"
+        self.done = 0
+        self.total = 0
+        self.result: Optional[str] = None
+        self.error: Optional[str] = None
+        self.created = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self._cancel = threading.Event()
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in (DONE, FAILED, CANCELLED)
+
+    def cancel(self):
+        self._cancel.set()
+
+    # progress callback handed to the work, it is also where cancellation takes effect
+    def progress(self, step: str, done: int = 0, total: int = 0):
+        if self._cancel.is_set():
+            raise JobCancelled()
+        self.step = step
+        self.done = done
+        self.total = total
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "action": self.action,
+            "status": self.status,
+            "progress": {"step": self.step, "done": self.done, "total": self.total},
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+class JobQueue:
+    """
+    Runs long jobs on a bounded pool of worker threads
+    :param concurrency: the number of jobs running at the same time
+    :param max_pending: the number of queued jobs before submit raises JobQueueFull
+    """
+
+    def __init__(self, concurrency: int = JOB_CONCURRENCY, max_pending: int = JOB_MAX_PENDING):
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="job")
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    # queue work(progress) to run in the background and return its job
+    def submit(self, action: str, work: Callable[[Callable], str]) -> Job:
+        job = Job(action)
+        with self._lock:
+            pending = sum(1 for j in self._jobs.values() if j.status == QUEUED)
+            if pending >= self.max_pending:
+                raise JobQueueFull("too many jobs are waiting, try again later")
+
+            self._jobs[job.id] = job
+            self._prune()
+
+        self._executor.submit(self._run, job, work)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        job = self.get(job_id)
+        if job is not None and not job.is_finished:
+            job.cancel()
+            if job.status == QUEUED:
+                job.status = CANCELLED
+                job.finished = time.time()
+        return job
+
+    def _run(self, job: Job, work: Callable[[Callable], str]):
+        if job.status == CANCELLED:
+            return
+
+        job.status = RUNNING
+        job.started = time.time()
+        try:
+            job.result = work(job.progress)
+            job.status = DONE
+        except JobCancelled:
+            job.status = CANCELLED
+        except Exception as e:
+            job.error = f"Error: {e}"
+            job.status = FAILED
+        job.finished = time.time()
+
+    # forget the oldest finished jobs beyond JOB_HISTORY
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.is_finished]
+        for job_id in finished[:max(0, len(finished) - JOB_HISTORY)]:
+            del self._jobs[job_id]
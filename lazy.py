@@ -0,0 +1,63 @@
+import threading
+import time
+from typing import Callable, Generic, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class Lazy(Generic[T]):
+    """
+    A resource that is slow to create, created on first use or ahead of time by warm_up.
+    Callers needing it at once block until it is ready, others can check ready first.
+    :param name: how the resource is reported by the readiness check
+    :param factory: creates the resource
+    """
+
+    def __init__(self, name: str, factory: Callable[[], T]):
+        self.name = name
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._value: Optional[T] = None
+        self._created = False
+        self.seconds: Optional[float] = None
+        self.error: Optional[str] = None
+
+    @property
+    def ready(self) -> bool:
+        return self._created
+
+    def get(self) -> T:
+        if self._created:
+            return self._value
+
+        with self._lock:
+            if not self._created:
+                start = time.perf_counter()
+                try:
+                    self._value = self._factory()
+                except Exception as e:
+                    # not cached, the next use tries again
+                    self.error = str(e)
+                    raise
+                self.seconds = time.perf_counter() - start
+                self.error = None
+                self._created = True
+        return self._value
+
+    def to_dict(self) -> dict:
+        return {"ready": self.ready, "seconds": self.seconds, "error": self.error}
+
+
+# create the resources one after another on a background thread
+def warm_up(*resources: Lazy) -> threading.Thread:
+    def run():
+        for resource in resources:
+            try:
+                resource.get()
+                print(f"{resource.name} ready in {resource.seconds:.2f}s")
+            except Exception as e:
+                print(f"error loading {resource.name}: {e}")
+
+    thread = threading.Thread(target=run, name="warm-up", daemon=True)
+    thread.start()
+    return thread
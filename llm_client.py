@@ -0,0 +1,313 @@
+import email.utils
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, NamedTuple, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import API_CALLS, API_RETRIES, API_SECONDS, API_TOKENS
+from response_cache import ResponseCache, is_cacheable
+
+OPENAI_API_BASE = os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1")
+
+# seconds a single HTTP attempt may take
+REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", "60"))
+# seconds a call may take in total, including every retry and backoff sleep
+REQUEST_DEADLINE = float(os.getenv("LLM_REQUEST_DEADLINE", "180"))
+MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "6"))
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 30.0
+POOL_SIZE = 16
+# streams are read for as long as the browser reads them, so they get connections of
+# their own and never hold up the calls that block on a response
+STREAM_POOL_SIZE = int(os.getenv("LLM_STREAM_CONCURRENCY", "16"))
+# cache deterministic (temperature 0) responses on disk, set LLM_CACHE=0 to disable
+CACHE_ENABLED = os.getenv("LLM_CACHE", "1") != "0"
+
+RETRY_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class LLMError(Exception):
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+# the API rejected the request itself, retrying will not help
+class LLMRequestError(LLMError):
+    pass
+
+
+# the account is out of credits
+class LLMQuotaError(LLMError):
+    pass
+
+
+# the retries were exhausted on errors that are normally transient
+class LLMUnavailableError(LLMError):
+    pass
+
+
+# the total deadline for the call ran out
+class LLMTimeoutError(LLMError):
+    pass
+
+
+# the text of a completion and why it ended: "stop", or "length" when max_tokens cut it off
+class Completion(NamedTuple):
+    text: str
+    finish_reason: Optional[str]
+
+
+def retry_after_seconds(response: requests.Response) -> Optional[float]:
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def error_from_response(response: requests.Response) -> LLMError:
+    try:
+        error = response.json().get("error") or {}
+    except ValueError:
+        error = {}
+
+    message = "%d %s" % (response.status_code, error.get("message") or response.reason)
+    if error.get("type") == "insufficient_quota" or error.get("code") == "insufficient_quota":
+        return LLMQuotaError(message, response.status_code)
+    if response.status_code in RETRY_STATUS_CODES:
+        return LLMUnavailableError(message, response.status_code)
+    return LLMRequestError(message, response.status_code)
+
+
+# release a slot taken earlier once the block is left
+@contextmanager
+def _released(slots: threading.BoundedSemaphore) -> Iterator[None]:
+    try:
+        yield
+    finally:
+        slots.release()
+
+
+class LLMClient:
+    """
+    OpenAI API client sharing one keep-alive connection pool between threads, with at most
+    POOL_SIZE requests and STREAM_POOL_SIZE streams in flight at a time, however many
+    threads call it
+    :param api_key: the OpenAI API key
+    :param timeout: seconds a single attempt may take
+    :param deadline: seconds a call may take in total, across all retries
+    :param max_retries: retries after the first attempt for transient errors
+    :param cache: where deterministic responses are cached, if anywhere
+    """
+
+    def __init__(
+            self,
+            api_key: str,
+            api_base: str = OPENAI_API_BASE,
+            timeout: float = REQUEST_TIMEOUT,
+            deadline: float = REQUEST_DEADLINE,
+            max_retries: int = MAX_RETRIES,
+            cache: Optional[ResponseCache] = None,
+    ):
+        self.api_base = api_base.rstrip("/")
+        self.timeout = timeout
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.cache = cache
+
+        # held for each attempt, and for the whole body of a stream, not while backing off.
+        # Waiting for one counts against the call's deadline
+        self.slots = threading.BoundedSemaphore(POOL_SIZE)
+        self.stream_slots = threading.BoundedSemaphore(STREAM_POOL_SIZE)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE + STREAM_POOL_SIZE)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Authorization": f"Bearer {api_key}",
+                                     "Content-Type": "application/json"})
+
+    def backoff(self, attempt: int) -> float:
+        # exponential backoff with full jitter
+        return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+    def post(self, path: str, payload: dict) -> dict:
+        if self.cache is None or not is_cacheable(payload):
+            return self._post_with_retries(path, payload)
+
+        key = ResponseCache.key(path, payload)
+        response_json = self.cache.get(key)
+        if response_json is None:
+            response_json = self._post_with_retries(path, payload)
+            self.cache.set(key, response_json)
+        else:
+            API_CALLS.inc(endpoint=path, outcome="cached")
+        return response_json
+
+    def _post_with_retries(self, path: str, payload: dict) -> dict:
+        try:
+            with API_SECONDS.time(endpoint=path):
+                response_json = self._send(path, payload).json()
+        except LLMError:
+            API_CALLS.inc(endpoint=path, outcome="error")
+            raise
+        API_CALLS.inc(endpoint=path, outcome="ok")
+        usage = response_json.get("usage") or {}
+        API_TOKENS.inc(usage.get("prompt_tokens", 0), endpoint=path, kind="prompt")
+        API_TOKENS.inc(usage.get("completion_tokens", 0), endpoint=path, kind="completion")
+        return response_json
+
+    # send a request, retrying transient errors, and return the successful response;
+    # a streamed response is retried only until its headers arrive, and is returned holding
+    # a stream slot, the caller releases it once the stream is read
+    def _send(self, path: str, payload: dict, stream: bool = False) -> requests.Response:
+        deadline = time.monotonic() + self.deadline
+        slots = self.stream_slots if stream else self.slots
+        attempt = 0
+
+        while True:
+            if not slots.acquire(timeout=max(0.0, deadline - time.monotonic())):
+                raise LLMTimeoutError("deadline of %.0fs exceeded for %s waiting for a connection"
+                                      % (self.deadline, path))
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                slots.release()
+                raise LLMTimeoutError("deadline of %.0fs exceeded for %s" % (self.deadline, path))
+
+            delay = None
+            try:
+                response = self.session.post(self.api_base + path, json=payload, stream=stream,
+                                             timeout=min(self.timeout, remaining))
+            except (requests.ConnectionError, requests.Timeout) as e:
+                slots.release()
+                error = LLMUnavailableError(str(e))
+            except BaseException:
+                slots.release()
+                raise
+            else:
+                if response.status_code == 200:
+                    if not stream:
+                        slots.release()
+                    return response
+                error = error_from_response(response)
+                delay = retry_after_seconds(response)
+                response.close()
+                slots.release()
+
+            if not isinstance(error, LLMUnavailableError) or attempt >= self.max_retries:
+                raise error
+
+            if delay is None:
+                delay = self.backoff(attempt)
+            if time.monotonic() + delay >= deadline:
+                raise LLMTimeoutError("deadline of %.0fs exceeded for %s: %s" % (self.deadline, path, error),
+                                      error.status_code)
+
+            print('error doing request (%s), retrying in %.1f seconds...' % (error, delay))
+            API_RETRIES.inc(endpoint=path)
+            time.sleep(delay)
+            attempt += 1
+
+    def complete(self, prompt: str, max_tokens: int, temperature: float,
+                 model: str = "text-davinci-003") -> str:
+        return self.completion(prompt, max_tokens, temperature, model).text.strip()
+
+    # like complete, with the text as generated and the finish reason
+    def completion(self, prompt: str, max_tokens: int, temperature: float,
+                   model: str = "text-davinci-003") -> Completion:
+        response_json = self.post("/completions", {
+            "model": model,
+            "prompt": prompt,
+            "temperature": temperature,
+            "max_tokens": max_tokens
+        })
+        choice = response_json["choices"][0]
+        return Completion(choice["text"], choice.get("finish_reason"))
+
+    def chat(self, messages: List[dict], max_tokens: int, temperature: float,
+             model: str = "gpt-3.5-turbo") -> str:
+        response_json = self.post("/chat/completions", {
+            "model": model,
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+        })
+        return response_json["choices"][0]["message"]["content"].strip()
+
+    # stream a chat completion, yielding the content as it is generated. The API reports
+    # no token usage for streams, only the call and its time are counted
+    def stream_chat(self, messages: List[dict], max_tokens: int, temperature: float,
+                    model: str = "gpt-3.5-turbo") -> Iterator[str]:
+        path = "/chat/completions"
+        start = time.perf_counter()
+        try:
+            response = self._send(path, {
+                "model": model,
+                "messages": messages,
+                "max_tokens": max_tokens,
+                "temperature": temperature,
+                "stream": True,
+            }, stream=True)
+        except LLMError:
+            API_CALLS.inc(endpoint=path, outcome="error")
+            raise
+
+        # server-sent events are UTF-8, requests would otherwise assume latin-1 for text/*
+        response.encoding = "utf-8"
+        with response, _released(self.stream_slots):
+            try:
+                for line in response.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        break
+                    try:
+                        content = json.loads(data)["choices"][0].get("delta", {}).get("content")
+                    except (ValueError, KeyError, IndexError, AttributeError) as e:
+                        raise LLMRequestError(f"malformed stream event {data[:100]!r}: {e}")
+                    if content:
+                        yield content
+            except LLMError:
+                API_CALLS.inc(endpoint=path, outcome="error")
+                raise
+            # a connection dropped mid-stream raises ChunkedEncodingError, not ConnectionError
+            except (requests.RequestException, ValueError) as e:
+                API_CALLS.inc(endpoint=path, outcome="error")
+                raise LLMUnavailableError(f"stream interrupted: {e}")
+        API_CALLS.inc(endpoint=path, outcome="ok")
+        API_SECONDS.observe(time.perf_counter() - start, endpoint=path)
+
+
+_clients: Dict[str, LLMClient] = {}
+_clients_lock = threading.Lock()
+_cache: Optional[ResponseCache] = None
+
+
+def get_cache() -> Optional[ResponseCache]:
+    global _cache
+    if CACHE_ENABLED and _cache is None:
+        _cache = ResponseCache()
+    return _cache
+
+
+# get the shared client for an API key, so its connections are reused across calls
+def get_client(api_key: str) -> LLMClient:
+    with _clients_lock:
+        if api_key not in _clients:
+            _clients[api_key] = LLMClient(api_key, cache=get_cache())
+        return _clients[api_key]
@@ -0,0 +1,262 @@
+import bisect
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple, TypeVar
+
+# set TRACE_LOG to a file path to append one JSON line per request with the time each
+# stage of it took, the API calls it made and the tokens they used
+TRACE_LOG = os.getenv("TRACE_LOG")
+# seconds, from a cache hit to a long summary
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+T = TypeVar("T")
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """
+    A count that only goes up, one per combination of label values
+    :param name: the metric name, ending in _total
+    :param help: what is counted
+    :param labels: the label names, every inc passes a value for each
+    """
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+        _add_to_trace(self.name, key, amount)
+
+    def value(self, **labels: str) -> float:
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            return self._values.get(key, 0.0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, key)} {value:g}")
+        return lines
+
+
+class Histogram:
+    """
+    How long something took, counted into cumulative buckets, one set per combination of
+    label values
+    :param name: the metric name, ending in _seconds
+    :param help: what is timed
+    :param labels: the label names, every observe passes a value for each
+    :param buckets: the upper bounds of the buckets, in increasing order
+    :param span: put before the label values to name what is timed in traces
+    """
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS, span: str = ""):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.span = span
+        self._lock = threading.Lock()
+        # per label values: the count in each bucket (not cumulative), the +Inf one last, and the sum
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            total[0] += value
+        _add_span(self.span + ",".join(key), value)
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels: str) -> int:
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            return sum(self._values[key][0]) if key in self._values else 0
+
+    def sum(self, **labels: str) -> float:
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            return self._values[key][1][0] if key in self._values else 0.0
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = 'le="+Inf"' if bound == float("inf") else f'le="{bound:g}"'
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total[0]:.6f}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+_registry: List = []
+
+
+def counter(name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+    metric = Counter(name, help, labels)
+    _registry.append(metric)
+    return metric
+
+
+def histogram(name: str, help: str, labels: Sequence[str] = (),
+              buckets: Sequence[float] = LATENCY_BUCKETS, span: str = "") -> Histogram:
+    metric = Histogram(name, help, labels, buckets, span)
+    _registry.append(metric)
+    return metric
+
+
+# every metric in the Prometheus text format, for the /metrics endpoint
+def render() -> str:
+    return "\n".join(line for metric in _registry for line in metric.render()) + "\n"
+
+
+REQUEST_SECONDS = histogram("gpt_assistant_request_seconds", "Time to answer a message, by action", ["action"],
+                            span="request ")
+STAGE_SECONDS = histogram("gpt_assistant_stage_seconds",
+                          "Time spent in each stage of answering a message", ["stage"])
+API_SECONDS = histogram("gpt_assistant_api_seconds",
+                        "Time an OpenAI API call took, retries included, by endpoint", ["endpoint"],
+                        span="api ")
+API_CALLS = counter("gpt_assistant_api_calls_total",
+                    "OpenAI API calls by endpoint and outcome (ok, error or cached)", ["endpoint", "outcome"])
+API_RETRIES = counter("gpt_assistant_api_retries_total", "OpenAI API requests retried, by endpoint", ["endpoint"])
+API_TOKENS = counter("gpt_assistant_api_tokens_total",
+                     "Tokens used by OpenAI API calls, by endpoint and kind (prompt or completion)",
+                     ["endpoint", "kind"])
+PAGES_FETCHED = counter("gpt_assistant_pages_fetched_total",
+                        "Pages fetched, by source (fresh, revalidated, downloaded or error)", ["source"])
+SECTION_EXTRACTIONS = counter("gpt_assistant_section_extractions_total",
+                              "Section summaries and keywords requested together, by whether the "
+                              "reply parsed (combined) or they were requested again (fallback)", ["result"])
+SUMMARY_CONTINUATIONS = counter("gpt_assistant_summary_continuations_total",
+                                "Requests made to continue a summary cut off by the token limit")
+
+
+# time a stage of answering a message, like segmenting text or saving the index
+def stage(name: str):
+    return STAGE_SECONDS.time(stage=name)
+
+
+class Trace:
+    """
+    What one request spent its time on: every stage timed and every counter increased
+    while it was current, in its own thread or threads started with in_context
+    :param name: what the request was, the action of a message
+    """
+
+    def __init__(self, name: str):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.start = time.time()
+        self.seconds: Optional[float] = None
+        self.error: Optional[str] = None
+        self._lock = threading.Lock()
+        self._spans: Dict[str, List[float]] = {}
+        self._counters: Dict[str, float] = {}
+
+    def add_span(self, name: str, seconds: float):
+        with self._lock:
+            span = self._spans.setdefault(name, [0, 0.0])
+            span[0] += 1
+            span[1] += seconds
+
+    def add_count(self, name: str, amount: float):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0.0) + amount
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "id": self.id,
+                "name": self.name,
+                "start": self.start,
+                "seconds": self.seconds,
+                "error": self.error,
+                "stages": {name: {"count": count, "seconds": round(seconds, 6)}
+                           for name, (count, seconds) in self._spans.items()},
+                "counters": dict(self._counters),
+            }
+
+
+_current_trace: contextvars.ContextVar = contextvars.ContextVar("trace", default=None)
+_trace_log_lock = threading.Lock()
+
+
+def _add_span(name: str, seconds: float):
+    current = _current_trace.get()
+    if current is not None:
+        current.add_span(name, seconds)
+
+
+def _add_to_trace(name: str, key: Tuple[str, ...], amount: float):
+    current = _current_trace.get()
+    if current is not None:
+        current.add_count(name + ("{" + ",".join(key) + "}" if key else ""), amount)
+
+
+# trace a request while the block runs and append it to log_path, a no-op yielding None
+# when no log is set
+@contextmanager
+def trace(name: str, log_path: Optional[str] = TRACE_LOG) -> Iterator[Optional[Trace]]:
+    if not log_path:
+        yield None
+        return
+
+    current = Trace(name)
+    token = _current_trace.set(current)
+    start = time.perf_counter()
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        current.seconds = time.perf_counter() - start
+        _current_trace.reset(token)
+        line = json.dumps(current.to_dict())
+        try:
+            with _trace_log_lock, open(log_path, "a") as file:
+                file.write(line + "\n")
+        except OSError as e:
+            print(f"error writing trace to {log_path}: {e}")
+
+
+# fn, run in the trace of the caller from whatever thread calls it, for thread pools
+def in_context(fn: Callable[..., T]) -> Callable[..., T]:
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(fn, *args, **kwargs)
@@ -1,74 +1,170 @@
-import json
-import requests
+import os
+import threading
 import time
-from typing import List
-import spacy
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, NamedTuple, Optional
 import math
 
-nlp = spacy.load("en_core_web_sm")
+from extractive import dedupe_sentences, extract_sentences
+from llm_client import Completion, get_client
+from metrics import STAGE_SECONDS, in_context, stage
+from tokens import count_tokens
+
+_nlp = None
+_nlp_lock = threading.Lock()
+
+# long texts are parsed in blocks of about this many characters so only one block's
+# Doc is held in memory at a time
+SEGMENT_BLOCK_CHARS = 100_000
+# longer sentences are split between words, the sentencizer finds no boundaries in
+# unpunctuated text like auto-generated captions
+MAX_SENTENCE_TOKENS = 200
+
+# snippets of one prompt compressed at the same time
+COMPRESSION_CONCURRENCY = int(os.getenv("COMPRESSION_CONCURRENCY", "4"))
+# "all" compresses every compressible snippet, "budget" only the fewest needed to fit the prompt
+COMPRESSION_PLAN = os.getenv("COMPRESSION_PLAN", "all")
+# the expected size of a compressed snippet relative to the original, for planning until
+# the prompt's own compressions have been seen
+COMPRESSION_ESTIMATE = 0.5
+# drop repeated sentences and, within limits, the least central ones before compressing
+# with the API, set EXTRACTIVE_COMPRESSION=0 to only compress with the API
+EXTRACTIVE_COMPRESSION = os.getenv("EXTRACTIVE_COMPRESSION", "1") == "1"
+# the least share of its (deduplicated) tokens the extractive stage may keep, a prompt
+# needing more cut than that is compressed by the API instead
+EXTRACTIVE_MIN_RATIO = float(os.getenv("EXTRACTIVE_MIN_RATIO", "0.5"))
+
+
+# a sentence span of a parsed text and its length in tokens
+class Sentence(NamedTuple):
+    text: str
+    tokens: int
+
+
+# the sentence segmentation pipeline: the rule-based tokenizer and sentencizer only,
+# no tagger/parser/ner, loaded once on first use
+def get_nlp():
+    global _nlp
+    with _nlp_lock:
+        if _nlp is None:
+            # imported here, spaCy takes a while to import and most requests never segment text
+            import spacy
+            nlp = spacy.blank("en")
+            nlp.add_pipe("sentencizer")
+            _nlp = nlp
+    return _nlp
+
+
+# cut text into blocks that end at a sentence boundary where possible
+def split_blocks(text: str, block_chars: int = SEGMENT_BLOCK_CHARS) -> List[str]:
+    blocks = []
+    start = 0
+    while len(text) - start > block_chars:
+        end = text.rfind(". ", start, start + block_chars)
+        if end == -1:
+            end = text.rfind(" ", start, start + block_chars)
+        end = start + block_chars if end == -1 else end + 1
+        blocks.append(text[start:end])
+        start = end
+    blocks.append(text[start:])
+    return blocks
+
+
+# split a sentence longer than max_tokens into pieces of at most max_tokens, between words,
+# or between characters within a word longer than that
+def split_sentence(sentence: Sentence, max_tokens: int) -> List[Sentence]:
+    if sentence.tokens <= max_tokens:
+        return [sentence]
+
+    pieces = []
+    words = []
+    tokens = 0
+
+    def flush():
+        if words:
+            text = " ".join(words)
+            pieces.append(Sentence(text, count_tokens(text)))
+            words.clear()
+
+    for word in sentence.text.split():
+        word_tokens = count_tokens(word)
+        if word_tokens > max_tokens:
+            flush()
+            tokens = 0
+            # a token is at least one character
+            for start in range(0, len(word), max_tokens):
+                piece = word[start:start + max_tokens]
+                pieces.append(Sentence(piece, count_tokens(piece)))
+            continue
+        if words:
+            # joined after a space, which the tokenizer counts with the word
+            word_tokens = count_tokens(" " + word)
+            if tokens + word_tokens > max_tokens:
+                flush()
+                tokens = 0
+                word_tokens = count_tokens(word)
+        words.append(word)
+        tokens += word_tokens
+    flush()
+    return pieces
+
+
+# parse text once into sentences that every later splitting stage reuses
+def segment(text: str) -> List[Sentence]:
+    nlp = get_nlp()
+    with stage("segment"):
+        return [piece
+                for doc in nlp.pipe(split_blocks(text))
+                for sent in doc.sents
+                for piece in split_sentence(Sentence(sent.text, count_tokens(sent.text)), MAX_SENTENCE_TOKENS)]
+
+
+def join_sentences(sentences: List[Sentence]) -> str:
+    return " ".join(sentence.text for sentence in sentences)
+
+
+# group consecutive sentences so each group has at most max_tokens tokens,
+# a sentence longer than max_tokens is split into groups of its own
+def group_sentences(sentences: List[Sentence], max_tokens: int) -> List[List[Sentence]]:
+    groups = []
+    current_group = []
+    current_tokens = 0
 
+    for sentence in (piece for sentence in sentences for piece in split_sentence(sentence, max_tokens)):
+        if current_group and current_tokens + sentence.tokens > max_tokens:
+            groups.append(current_group)
+            current_group = []
+            current_tokens = 0
 
-def split_text_into_chunks(text, max_tokens=4000):
-    doc = nlp(text)
-    chunks = []
-    current_chunk = []
-    current_tokens = 0
+        current_group.append(sentence)
+        current_tokens += sentence.tokens
 
-    for sentence in doc.sents:
-        sentence_tokens = len(sentence)
-        if current_tokens + sentence_tokens <= max_tokens:
-            current_chunk.append(sentence.text)
-            current_tokens += sentence_tokens
-        else:
-            chunks.append(" ".join(current_chunk))
-            current_chunk = [sentence.text]
-            current_tokens = sentence_tokens
-
-    if current_chunk:
-        chunks.append(" ".join(current_chunk))
-
-    return chunks
-
-
-def do_request(api_key, prompt_string, result_tokens, max_chars, temperature=0.7):
-    if len(prompt_string) > max_chars:
-        raise ValueError("prompt string is too long %d/%d" %
-                         (len(prompt_string), max_chars))
-
-    # call the openai completions API
-    req_data = {
-        "model": "text-davinci-003",
-        "prompt": prompt_string,
-        "temperature": temperature,
-        "max_tokens": result_tokens
-    }
-
-    response = requests.post(
-        "https://api.openai.com/v1/completions",
-        headers={"Authorization": "Bearer " + api_key,
-                 "Content-Type": "application/json"},
-        data=json.dumps(req_data)
-    )
-
-    while not response.json().get("choices"):
-        response_json = response.json()
-
-        if response_json.get('error') is not None:
-            response_type = response_json.get('error').get('type')
-            if response_type in ["insufficient_quota", "invalid_request_error"]:
-                print(response_json.get('error').get('message'))
-                exit(1)
-
-        print('error doing request, retrying in 5 seconds...')
-        time.sleep(5)
-        response = requests.post(
-            "https://api.openai.com/v1/completions",
-            headers={"Authorization": "Bearer " + api_key,
-                     "Content-Type": "application/json"},
-            data=json.dumps(req_data)
-        )
+    if current_group:
+        groups.append(current_group)
+
+    return groups
+
+
+def split_text_into_chunks(text, max_tokens=4000, sentences: Optional[List[Sentence]] = None):
+    if sentences is None:
+        sentences = segment(text)
+    return [join_sentences(group) for group in group_sentences(sentences, max_tokens)]
+
+
+def do_request(api_key, prompt_string, result_tokens, max_prompt_tokens, temperature=0.7):
+    return do_completion(api_key, prompt_string, result_tokens, max_prompt_tokens, temperature).text.strip()
+
+
+# like do_request, with the text as generated and whether max tokens cut it off
+def do_completion(api_key, prompt_string, result_tokens, max_prompt_tokens, temperature=0.7) -> Completion:
+    prompt_tokens = count_tokens(prompt_string)
+    if prompt_tokens > max_prompt_tokens:
+        raise ValueError("prompt string is too long %d/%d tokens" %
+                         (prompt_tokens, max_prompt_tokens))
 
-    return response.json().get("choices")[0].get('text').strip()
+    # call the openai completions API, transient errors are retried by the client
+    # and anything else is raised as an LLMError
+    return get_client(api_key).completion(prompt_string, result_tokens, temperature)
 
 
 TOKEN_BUFFER = 100
@@ -86,10 +182,15 @@ class Config:
             openai_api_key: str,
             temperature: float,
             target_tokens: int = 1500,
+            compression_concurrency: int = COMPRESSION_CONCURRENCY,
+            compression_plan: str = COMPRESSION_PLAN,
+            extractive: bool = EXTRACTIVE_COMPRESSION,
+            extractive_min_ratio: float = EXTRACTIVE_MIN_RATIO,
     ):
         self.max_tokens = max_tokens-TOKEN_BUFFER
         self.result_tokens = result_tokens-TOKEN_BUFFER
-        self.max_chars = (max_tokens - result_tokens) * 4
+        # tokens left for the prompt once the result tokens are reserved
+        self.max_prompt_tokens = max_tokens - result_tokens
 
         self.final_prefix = final_prefix
         self.final_suffix = final_suffix
@@ -97,11 +198,17 @@ class Config:
         self.openai_api_key = openai_api_key
         self.temperature = temperature
         self.target_tokens = target_tokens
+        if compression_plan not in ("all", "budget"):
+            raise ValueError(f"unknown compression plan {compression_plan!r}, expected all or budget")
+        self.compression_concurrency = max(1, compression_concurrency)
+        self.compression_plan = compression_plan
+        self.extractive = extractive
+        self.extractive_min_ratio = extractive_min_ratio
 
 
 # a single part of a prompt
 class Snippet:
-    def __init__(self, text, compression=False, config: Config = None):
+    def __init__(self, text, compression=False, config: Config = None, sentences: List[Sentence] = None):
         if config is None:
             raise ValueError("config must be provided")
 
@@ -114,6 +221,17 @@ class Snippet:
 
         self.text = text
         self.compression = compression
+        # the sentence spans of text, if they are already known
+        self.sentences = sentences
+
+    @property
+    def text(self) -> str:
+        return self._text
+
+    @text.setter
+    def text(self, text: str):
+        self._text = text
+        self._tokens = None
 
     def __len__(self):
         return len(self.text)
@@ -121,55 +239,39 @@ class Snippet:
     def __str__(self):
         return self.text.strip()
 
+    # the number of model tokens, counted once per text
+    def token_count(self) -> int:
+        if self._tokens is None:
+            if self.sentences is not None:
+                self._tokens = sum(sentence.tokens for sentence in self.sentences)
+            else:
+                self._tokens = count_tokens(str(self))
+        return self._tokens
+
     def subdivide(self):
-        doc = nlp(self.text)
-        sentences = list(doc.sents)
+        if self.sentences is None:
+            self.sentences = segment(self.text)
 
-        if len(doc) <= self._config.target_tokens:
+        if sum(sentence.tokens for sentence in self.sentences) <= self._config.target_tokens:
             return [self]
 
-        chunks = []
-        current_chunk = []
-        current_chunk_tokens = 0
-
-        for sent in sentences:
-            sent_tokens = len(sent)
-
-            if current_chunk_tokens + sent_tokens > self._config.target_tokens:
-                chunks.append(Snippet(" ".join(current_chunk),
-                              compression=self.compression, config=self._config))
-                current_chunk = []
-                current_chunk_tokens = 0
-
-            current_chunk.append(sent.text)
-            current_chunk_tokens += sent_tokens
-
-        if current_chunk:
-            chunks.append(Snippet(" ".join(current_chunk),
-                          compression=self.compression, config=self._config))
-
-        subdivided = []
-        for chunk in chunks:
-            subdivided.extend(chunk.subdivide())
-
-        return subdivided
+        return [Snippet(join_sentences(group), compression=self.compression, config=self._config, sentences=group)
+                for group in group_sentences(self.sentences, self._config.target_tokens)]
 
     def compress(self, prefix: str = None):
         if prefix is None:
             prefix = self._config.compression_prefix
 
+        self.sentences = None
         self.text = do_request(
             self._config.openai_api_key,
             prefix + self.text,
             self._config.result_tokens,
-            self._config.max_chars,
+            self._config.max_prompt_tokens,
             self._config.temperature
         )
 
 
-nlp = spacy.load("en_core_web_sm")
-
-
 class Prompt:
     def __init__(self, config: Config = None):
         """
@@ -192,107 +294,222 @@ class Prompt:
         self._suffix: Snippet = Snippet(
             config.final_suffix, compression=False, config=config)
 
-    # defragment snippets to fit within the max length
-    def defragment(self):
-        new_snippets = []
-
-        total_length = 0
-        accumulated_snippets = []
+        # running totals of the built prompt, updated as snippets are added or changed
+        self._chars = 0
+        self._tokens = 0
+        # operation counts and timings, to check prompt assembly scales linearly
+        self.stats = {"builds": 0, "size_updates": 0, "repeated_sentences": 0, "extracted_sentences": 0,
+                      "extract_seconds": 0.0, "merges": 0, "compressions": 0, "compress_seconds": 0.0,
+                      "optimize_seconds": 0.0}
+        self._track(self._prefix)
+        self._track(self._suffix)
+
+    # add (sign=1) or remove (sign=-1) a snippet from the running totals
+    def _track(self, snippet: Snippet, sign: int = 1):
+        self._chars += sign * len(str(snippet))
+        self._tokens += sign * snippet.token_count()
+        self.stats["size_updates"] += 1
+
+    def _set_snippets(self, snippets: List[Snippet]):
+        for s in self._snippets:
+            self._track(s, -1)
+        self._snippets = []
+        self.add(*snippets)
+
+    # extractive compression: drop sentences repeating one shortly before them, then, if
+    # the prompt is still too long and keeping extractive_min_ratio of the rest is enough,
+    # keep the most central sentences (by TextRank over TF-IDF vectors) that fit. Sentences
+    # longer than the room left are split first; if what fits still fills less than
+    # extractive_min_ratio of it, nothing is extracted and the API compresses the prompt.
+    # Only for prompts whose snippets may all be compressed
+    def extract(self):
+        if not self._snippets or not all(s.compression for s in self._snippets):
+            return
 
-        for i in range(len(self._snippets)):
+        start = time.perf_counter()
+        sentences = [sentence for s in self._snippets
+                     for sentence in (s.sentences if s.sentences is not None else segment(s.text))]
+        kept = dedupe_sentences(sentences)
+        repeated = len(sentences) - len(kept)
+
+        budget = self._config.max_prompt_tokens - (self.token_count() - sum(s.token_count() for s in self._snippets))
+        kept_tokens = sum(sentence.tokens for sentence in kept)
+        extracted = 0
+        if budget < kept_tokens <= budget / self._config.extractive_min_ratio:
+            pieces = [piece for sentence in kept for piece in split_sentence(sentence, budget)]
+            chosen = extract_sentences(pieces, budget)
+            if sum(sentence.tokens for sentence in chosen) >= budget * self._config.extractive_min_ratio:
+                extracted = len(pieces) - len(chosen)
+                kept = chosen
+
+        if repeated or extracted:
+            self._set_snippets([Snippet(join_sentences(group), compression=True, config=self._config, sentences=group)
+                                for group in group_sentences(kept, self._config.target_tokens)])
+        seconds = time.perf_counter() - start
+        self.stats["repeated_sentences"] += repeated
+        self.stats["extracted_sentences"] += extracted
+        self.stats["extract_seconds"] += seconds
+        STAGE_SECONDS.observe(seconds, stage="extract")
+        print("dropped %d repeated and %d less central of %d sentences in %.2fs - total:%d->target:%d" % (
+            repeated, extracted, len(sentences), seconds, self.token_count(), self._config.max_prompt_tokens))
+
+    # pack neighbouring compressible snippets into as few snippets of at most target_tokens
+    # as their order allows, so compressing them takes fewer, fuller requests. Snippets that
+    # may not be compressed stay where they are and end the snippets packed before them
+    def defragment(self):
+        compression_tokens = count_tokens(self._config.compression_prefix)
+        max_tokens = min(self._config.target_tokens, self._config.max_prompt_tokens - compression_tokens)
 
-            # if the snippet is not compressible, add it to the accumulated snippets
-            # as it cannot be compressed so it must be included in the final prompt regardless
-            if not self._snippets[i].compression:
-                new_snippets.append(self._snippets[i])
-                total_length += len(self._snippets[i])
+        new_snippets = []
+        group: List[Snippet] = []
+        group_tokens = 0
+
+        def flush():
+            if len(group) == 1:
+                new_snippets.append(group[0])
+            elif group:
+                sentences = None
+                if all(s.sentences is not None for s in group):
+                    sentences = [sentence for s in group for sentence in s.sentences]
+                new_snippets.append(Snippet(" ".join(str(s) for s in group), compression=True,
+                                            config=self._config, sentences=sentences))
+            group.clear()
+
+        for snippet in self._snippets:
+            if not snippet.compression:
+                flush()
+                group_tokens = 0
+                new_snippets.append(snippet)
                 continue
 
-            if total_length + len(self._snippets[i]) > self._config.max_chars:
-                # combine the accumulated snippets into a single snippet
-                new_snippets.append(
-                    Snippet("".join([str(s) for s in accumulated_snippets])))
-                accumulated_snippets = [self._snippets[i]]
-            else:
-                accumulated_snippets.append(self._snippets[i])
-
-        # if no new snippets were created, return the original snippets
-        if len(new_snippets) == 0:
-            return
-
-        # add the remaining snippets
-        if len(accumulated_snippets) > 0:
-            new_snippets.append(
-                Snippet("".join([str(s) for s in accumulated_snippets])))
-
-        self._snippets = new_snippets
+            if group and group_tokens + snippet.token_count() > max_tokens:
+                flush()
+                group_tokens = 0
+            group.append(snippet)
+            group_tokens += snippet.token_count()
+        flush()
+
+        if len(new_snippets) < len(self._snippets):
+            self.stats["merges"] += len(self._snippets) - len(new_snippets)
+            self._set_snippets(new_snippets)
+
+    # the indexes of the snippets to compress, in prompt order. The budget plan takes the
+    # fewest snippets, largest first, that fit the prompt if each shrinks by ratio (and to
+    # at most result_tokens, the most a compression returns). Ties go to the later snippet
+    def plan_compression(self, exclude=(), ratio: float = COMPRESSION_ESTIMATE) -> List[int]:
+        candidates = [i for i, s in enumerate(self._snippets) if s.compression and i not in exclude]
+        if self._config.compression_plan == "all":
+            return candidates
+
+        excess = self.token_count() - self._config.max_prompt_tokens
+        chosen = []
+        for i in sorted(candidates, key=lambda i: (-self._snippets[i].token_count(), -i)):
+            if excess <= 0:
+                break
+            chosen.append(i)
+            tokens = self._snippets[i].token_count()
+            excess -= tokens - min(self._config.result_tokens, int(tokens * ratio))
+        return sorted(chosen)
 
     def compress(self, prefix: str = None):
         if prefix is None:
             prefix = self._config.compression_prefix
 
-        # walk backwards through each snippet and compress it,
-        # if it allows compression, until the prompt is within the max length
-        for i in range(len(self._snippets) - 1, -1, -1):
-            if self._snippets[i].compression:
-                original_len = len(self._snippets[i])
-                self._snippets[i].compress(prefix=prefix)
-                new_len = len(self._snippets[i])
-                saved = original_len - new_len
-                print(
-                    "compressed snippet %d/%d from %d->%s (saved %d) chars - total:%d->target:%d" % (
-                        i + 1,
-                        len(self._snippets),
-                        original_len,
-                        new_len,
-                        saved,
-                        len(self),
-                        self._config.max_chars
-                    )
-                )
-                if len(self) < self._config.max_chars and False:
-                    break
-
-        # defragment the prompt to combine snippets that can be compressed
-        # self.defragment()
+        start = time.perf_counter()
+        calls = 0
+        compressed = set()
+        ratio = COMPRESSION_ESTIMATE
+        while True:
+            indexes = self.plan_compression(exclude=compressed, ratio=ratio)
+            if not indexes:
+                break
+            ratio = self._compress_snippets(indexes, prefix)
+            calls += len(indexes)
+            compressed.update(indexes)
+            # with the budget plan, snippets that shrank less than planned leave the prompt
+            # over budget and the others are planned again with the ratio seen
+            if self._config.compression_plan == "all" or self.token_count() <= self._config.max_prompt_tokens:
+                break
+
+        seconds = time.perf_counter() - start
+        self.stats["compress_seconds"] += seconds
+        STAGE_SECONDS.observe(seconds, stage="compress")
+        print("compressed %d/%d snippets in %.2fs - total:%d->target:%d" % (
+            calls, len(self._snippets), seconds, self.token_count(), self._config.max_prompt_tokens))
+
+    # compress the snippets at indexes concurrently and return how much they shrank. Each
+    # result replaces its own snippet, so the prompt is the same whatever order the
+    # requests finish in
+    def _compress_snippets(self, indexes: List[int], prefix: str) -> float:
+        snippets = [self._snippets[i] for i in indexes]
+        original_tokens = [s.token_count() for s in snippets]
+        for s in snippets:
+            self._track(s, -1)
+        with ThreadPoolExecutor(max_workers=min(self._config.compression_concurrency, len(snippets))) as pool:
+            futures = [pool.submit(in_context(s.compress), prefix) for s in snippets]
+        # the pool has waited for every request, a failed one left its snippet unchanged
+        for s in snippets:
+            self._track(s)
+        self.stats["compressions"] += len(snippets)
+
+        for i, s, tokens in zip(indexes, snippets, original_tokens):
+            print("compressed snippet %d/%d from %d->%d (saved %d) tokens" % (
+                i + 1, len(self._snippets), tokens, s.token_count(), tokens - s.token_count()))
+        for future in futures:
+            future.result()
+        return sum(s.token_count() for s in snippets) / max(1, sum(original_tokens))
 
     # add a snippet to the prompt
     def add(self, *snippets: Snippet):
+        for s in snippets:
+            self._track(s)
         self._snippets.extend(snippets)
 
     # build the full prompt string
     def build(self) -> str:
-        prompt = str(self._prefix)
-        for s in self._snippets:
-            prompt += str(s)
-        prompt += str(self._suffix)
-        return prompt
+        self.stats["builds"] += 1
+        return "".join([str(self._prefix)] + [str(s) for s in self._snippets] + [str(self._suffix)])
 
     def optimize(self):
-        if len(self) < self._config.max_chars:
+        start = time.perf_counter()
+        try:
+            self._optimize()
+        finally:
+            seconds = time.perf_counter() - start
+            self.stats["optimize_seconds"] += seconds
+            STAGE_SECONDS.observe(seconds, stage="optimize")
+
+    def _optimize(self):
+        if self.token_count() <= self._config.max_prompt_tokens:
             return
 
+        # shorten the prompt locally first, the API is only asked if that is not enough
+        if self._config.extractive:
+            self.extract()
+            if self.token_count() <= self._config.max_prompt_tokens:
+                return
+
         # compress the prompt
+        self.defragment()
         self.compress()
 
-        # if the prompt is still too long, join snippets together and subdivide them
-        if len(self) > self._config.max_chars:
-            print(
-                "prompt is still too long, joining snippets together subdividing & compressing...")
-            # join all snippets together
-            joined = Snippet("".join([str(s) for s in self._snippets]))
-            # subdivide the joined snippet
-            self._snippets = joined.subdivide()
-
-            # try compressing on a second pass
+        # if the prompt is still too long, pack the compressed snippets together and
+        # compress them on a second pass
+        if self.token_count() > self._config.max_prompt_tokens:
+            print("prompt is still too long, packing snippets together & compressing...")
+            self.defragment()
             self.compress()
 
     def __str__(self):
         return self.build()
 
-    # calculate the number of characters in the prompt
+    # the number of characters in the prompt
     def __len__(self):
-        return len(self.build())
+        return self._chars
+
+    # the number of model tokens in the prompt, summed over its parts
+    def token_count(self) -> int:
+        return self._tokens
 
     def get_snippets(self):
         return self._snippets
@@ -302,6 +519,6 @@ class Prompt:
         print(f"suffix: {len(self._suffix)}")
         print(f"snippets: {len(self._snippets)}")
         for s in self._snippets:
-            print(f"  snippet: {len(s)}")
-        print(f"total chars: {len(self)}/{self._config.max_chars}")
-        print(f"total tokens: {len(self) // 4}/{self._config.max_tokens}")
+            print(f"  snippet: {len(s)} chars, {s.token_count()} tokens")
+        print(f"total chars: {len(self)}")
+        print(f"total tokens: {self.token_count()}/{self._config.max_prompt_tokens}")
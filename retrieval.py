@@ -0,0 +1,55 @@
+import os
+from typing import Iterable, List, Optional, Tuple
+
+from metrics import stage
+from tokens import CHAT_MODEL, count_message_tokens, count_tokens
+
+# index hits considered for each chat turn, 0 turns retrieval off
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "4"))
+# hits less similar to the user's message than this are left out
+RETRIEVAL_MIN_SCORE = float(os.getenv("RETRIEVAL_MIN_SCORE", "0.8"))
+# the most prompt tokens the retrieved snippets may take
+RETRIEVAL_TOKENS = int(os.getenv("RETRIEVAL_TOKENS", "1000"))
+RETRIEVAL_PREFIX = "Notes from earlier conversations and documents that may be relevant:\n"
+
+
+# the top_k stored snippets most similar to query as (text, score), best first, from the
+# shared documents and the turns of session only. Only the query is embedded, no
+# completion is requested
+def retrieve(store, query: str, session: Optional[str], top_k: int = RETRIEVAL_TOP_K,
+             min_score: float = RETRIEVAL_MIN_SCORE) -> List[Tuple[str, float]]:
+    if top_k <= 0:
+        return []
+
+    try:
+        with stage("retrieve"):
+            hits = [(hit.text, hit.score) for hit in store.search(query, top_k, session)]
+    except Exception as e:
+        # chat still works without the notes
+        print(f"error retrieving notes: {e}")
+        return []
+
+    return sorted([hit for hit in hits if hit[1] >= min_score], key=lambda hit: hit[1], reverse=True)
+
+
+# a system message with the best hits that fit in max_tokens, skipping text already in
+# the conversation, or None when nothing fits
+def pack_context(hits: List[Tuple[str, float]], max_tokens: int = RETRIEVAL_TOKENS,
+                 exclude: Iterable[str] = ()) -> Optional[dict]:
+    exclude = set(exclude)
+    budget = max_tokens - count_message_tokens({"content": RETRIEVAL_PREFIX})
+    snippets = []
+    for text, score in hits:
+        text = text.strip()
+        if not text or text in exclude:
+            continue
+        tokens = count_tokens(text + "\n\n", CHAT_MODEL)
+        if tokens > budget:
+            continue
+        snippets.append(text)
+        exclude.add(text)
+        budget -= tokens
+
+    if not snippets:
+        return None
+    return {"role": "system", "content": RETRIEVAL_PREFIX + "\n\n".join(snippets)}
@@ -38,6 +38,9 @@ document.addEventListener('DOMContentLoaded', function () {
 });
 
 
+// Stream chat replies as they are generated instead of waiting for the whole reply
+const STREAM_CHAT = true;
+
 function createTypingIndicator() {
     let msg = $('<div>').addClass('message').addClass('bot').attr('id', 'typing-indicator');
     let label = $('<div>').addClass('label').addClass('bot-label').text('Chatbot');
@@ -71,13 +74,23 @@ function markdownToHtml(text) {
 
 
 function appendMessage(who, text) {
+    let content = $('<div>');
+    appendMessageElement(who, content);
+    setMessageText(content, text);
+}
+
+function appendMessageElement(who, content) {
     let msg = $('<div>').addClass('message').addClass(who === 'user' ? 'user' : 'bot');
     let label = $('<div>').addClass('label').addClass(who === 'user' ? 'user-label' : 'bot-label').text(who === 'user' ? 'You' : 'Chatbot');
-    let replacedText = markdownToHtml(text);
-    let content = $('<div>').html(replacedText.startsWith('<pre>') && replacedText.endsWith('</pre>') ? replacedText + '<button class="copy-button">Copy code</button>' : replacedText);
-        msg.append(label).append(content);
+    msg.append(label).append(content);
     $('#chatbox').append(msg);
     $('#chatbox').scrollTop($('#chatbox')[0].scrollHeight);
+}
+
+function setMessageText(content, text) {
+    let replacedText = markdownToHtml(text);
+    content.html(replacedText.startsWith('<pre>') && replacedText.endsWith('</pre>') ? replacedText + '<button class="copy-button">Copy code</button>' : replacedText);
+    $('#chatbox').scrollTop($('#chatbox')[0].scrollHeight);
 
     // Add the "Copy to clipboard" button to all code blocks
     content.find('pre code').each(function () {
@@ -85,7 +98,6 @@ function appendMessage(who, text) {
     });
 }
 
-
 function showTypingIndicator() {
     let typingIndicator = createTypingIndicator();
     $('#chatbox').append(typingIndicator);
@@ -138,12 +150,18 @@ $('#chat-form').on('submit', function (event) {
     $('#user-input').val('');
 
     showTypingIndicator();
-    sendMessage(userInput, actionSelector)
+    if (actionSelector === 'general' && STREAM_CHAT) {
+        streamMessage(userInput);
+    } else {
+        sendMessage(userInput, actionSelector)
+    }
 });
 
 function sendMessage(userInput, actionSelector) {
     $.post('/message', { input: userInput, action: actionSelector }, function (data) {
-        if (data.response_type === 'error') {
+        if (data.response_type === 'job') {
+            pollJob(data.job.id);
+        } else if (data.response_type === 'error') {
             hideTypingIndicator();
             alert("An error occurred: " + data.response);
         } else {
@@ -153,6 +171,106 @@ function sendMessage(userInput, actionSelector) {
     });
 }
 
+// Poll a background job, showing its progress in the typing indicator until it finishes
+function pollJob(jobId) {
+    let cancel = $('<a>').attr('href', '#').addClass('ms-2').text('Cancel').on('click', function (event) {
+        event.preventDefault();
+        $.post('/jobs/' + jobId + '/cancel');
+    });
+    $('#typing-indicator .typing-indicator').append(cancel);
+
+    let timer = setInterval(function () {
+        $.get('/jobs/' + jobId, function (job) {
+            if (job.status === 'queued' || job.status === 'running') {
+                let step = job.progress.step;
+                if (job.progress.total > 0) {
+                    step += ' (' + job.progress.done + '/' + job.progress.total + ' sections done)';
+                }
+                $('#typing-indicator .job-progress').remove();
+                $('#typing-indicator .typing-indicator').append($('<span>').addClass('job-progress ms-2').text(step));
+                return;
+            }
+
+            clearInterval(timer);
+            hideTypingIndicator();
+            if (job.status === 'cancelled') {
+                appendMessage('bot', 'Cancelled.');
+                return;
+            }
+            $.get('/jobs/' + jobId + '/result', function (data) {
+                if (data.response_type === 'error') {
+                    alert("An error occurred: " + data.response);
+                } else {
+                    appendMessage('bot', data.response);
+                }
+            });
+        });
+    }, 1000);
+}
+
+// Stream the chat reply from /message/stream, rendering it as it arrives
+function streamMessage(userInput) {
+    let content = null;
+    let text = '';
+
+    function handleEvent(event, data) {
+        if (event === 'delta') {
+            if (content === null) {
+                hideTypingIndicator();
+                content = $('<div>');
+                appendMessageElement('bot', content);
+            }
+            text += data.content;
+            setMessageText(content, text);
+        } else if (event === 'done') {
+            hideTypingIndicator();
+            if (content === null) {
+                appendMessage('bot', data.response);
+            }
+        } else if (event === 'error') {
+            hideTypingIndicator();
+            alert("An error occurred: " + data.response);
+        }
+    }
+
+    fetch('/message/stream', { method: 'POST', body: new URLSearchParams({ input: userInput }) })
+        .then(async function (response) {
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) {
+                    break;
+                }
+                buffer += decoder.decode(value, { stream: true });
+
+                // events are separated by a blank line
+                let boundary;
+                while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                    const block = buffer.substring(0, boundary);
+                    buffer = buffer.substring(boundary + 2);
+
+                    let event = 'message';
+                    let data = '';
+                    block.split('\n').forEach(function (line) {
+                        if (line.startsWith('event:')) {
+                            event = line.substring(6).trim();
+                        } else if (line.startsWith('data:')) {
+                            data += line.substring(5).trim();
+                        }
+                    });
+                    handleEvent(event, JSON.parse(data));
+                }
+            }
+        })
+        .catch(function (error) {
+            hideTypingIndicator();
+            alert("An error occurred: " + error);
+        });
+}
+
 
 setInterval(function () {
     let visibleDots = 0;
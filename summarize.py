@@ -1,12 +1,18 @@
+import json
 import re
 import subprocess
 import sys
 import os
-import requests
-import hashlib
-from prompt_wizard import Prompt, Snippet, do_request, Config
-import spacy
-from typing import Tuple
+from prompt_wizard import (EXTRACTIVE_COMPRESSION, Prompt, Snippet, Sentence, do_completion, do_request, Config,
+                           join_sentences, segment)
+from extractive import dedupe_lines
+from fetch import fetch_page, url_to_filename
+from metrics import SECTION_EXTRACTIONS, STAGE_SECONDS, SUMMARY_CONTINUATIONS, in_context, stage
+from tokens import count_tokens
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
 
 OPENAI_API_KEY = os.environ['OPENAI_API_KEY']
 
@@ -26,51 +32,263 @@ FINAL_SUFFIX = """
 COMPRESSION_PREFIX = "Write a paragraph with the important information from the following text: \n\n"
 KEYWORD_PREFIX = "List the most relevant keywords (e.g. #tag1, #tag2) (lowercase, single words) for the following text: \n\n"
 
-TEMPERATURE = 0.0
+EXTRACTION_PREFIX = """Extract details of the following text. Write an appropriate heading for each talking point, followed by a paragraph explaining what was discussed, and list the most relevant keywords (lowercase, single words).
+
+Here is the text:
+```
+"""
+
+EXTRACTION_SUFFIX = """
+```
+
+Answer with JSON only, in this format:
+{"topics": [{"heading": "...", "paragraph": "..."}], "tags": ["tag1", "tag2"]}
+"""
 
+TEMPERATURE = 0.0
 
-def clean_text(text: str) -> str:
+# progress(step, done, total) is called as handle_text moves through its steps,
+# raising from it aborts the summary
+Progress = Callable[[str, int, int], None]
+
+# maximum number of sections summarized at the same time
+SUMMARY_CONCURRENCY = int(os.getenv("SUMMARY_CONCURRENCY", "4"))
+# number of partial summaries merged into one on each reduce level
+REDUCE_FAN_IN = 4
+# requests to continue a summary cut off by the result tokens, after which its unfinished
+# last paragraph is dropped
+SUMMARY_MAX_CONTINUATIONS = int(os.getenv("SUMMARY_MAX_CONTINUATIONS", "2"))
+# a continuation with room for fewer tokens than this is not worth a request
+MIN_CONTINUATION_TOKENS = 50
+# "combined" asks for a section's summary and keywords in one JSON response, falling back
+# to "separate" requests for each when the response cannot be parsed
+SUMMARY_EXTRACTION = os.getenv("SUMMARY_EXTRACTION", "combined")
+
+# continuation requests made by generate_summary, to catch runaway token spending
+continuation_stats = {"summaries": 0, "continued": 0, "continuations": 0, "max_continuations": 0,
+                      "truncated": 0, "continuation_seconds": 0.0}
+_stats_lock = threading.Lock()
+# sections extracted with one combined request, and those that fell back to two
+extraction_stats = {"combined": 0, "fallback": 0}
+
+
+# the text of a transcript without its SRT cue numbers and timestamps. With dedupe, by
+# default when extractive compression is on, an SRT transcript also loses the lines
+# repeating one shortly before them, like captions rolling over several cues; other text,
+# like a page, keeps its lines as they are
+def clean_text(text: str, dedupe: bool = EXTRACTIVE_COMPRESSION) -> str:
     timestamp_pattern = r"(\d{2}:\d{2}:\d{2},\d{3}) --> (\d{2}:\d{2}:\d{2},\d{3})"
     lines = text.strip().split("\n")
-    cleaned_lines = [line for line in lines if not re.match(timestamp_pattern, line) and line != ""]
+    cleaned_lines = []
+    is_srt = False
+    for i, line in enumerate(lines):
+        if re.match(timestamp_pattern, line):
+            is_srt = True
+            continue
+        if line.strip() == "":
+            continue
+        # the cue number on the line before a timestamp
+        if line.strip().isdigit() and i + 1 < len(lines) and re.match(timestamp_pattern, lines[i + 1]):
+            continue
+        cleaned_lines.append(line)
+    if dedupe and is_srt:
+        cleaned_lines = dedupe_lines(cleaned_lines)
     return " ".join(cleaned_lines).strip()
 
-def generate_summary(prompt_config, content):
+# whether a completion was cut off before it finished, by its finish reason or, when the
+# API reports none, by its last sentence being unfinished
+def is_truncated(completion) -> bool:
+    if completion.finish_reason is not None:
+        return completion.finish_reason == "length"
+    return not completion.text.rstrip().endswith(".")
+
+
+def record_continuations(continuations: int, truncated: bool, seconds: float):
+    with _stats_lock:
+        continuation_stats["summaries"] += 1
+        continuation_stats["continued"] += 1 if continuations else 0
+        continuation_stats["continuations"] += continuations
+        continuation_stats["max_continuations"] = max(continuation_stats["max_continuations"], continuations)
+        continuation_stats["truncated"] += 1 if truncated else 0
+        continuation_stats["continuation_seconds"] += seconds
+    if continuations:
+        SUMMARY_CONTINUATIONS.inc(continuations)
+
+
+def generate_summary(prompt_config, content, sentences: Optional[List[Sentence]] = None):
     prompt = Prompt(prompt_config)
-    content_snippet = Snippet(content, compression=True, config=prompt_config)
+    content_snippet = Snippet(content, compression=True, config=prompt_config, sentences=sentences)
     prompt.add(*content_snippet.subdivide())
     prompt.optimize()
     final_prompt = prompt.build()
-    
-    final_response = ""
-    while True:
-        final_response = do_request(prompt_config.openai_api_key, final_prompt,
-                                    prompt_config.result_tokens,
-                                    prompt_config.max_chars,
-                                    prompt_config.temperature)
-        last_paragraph = final_response.split('\n\n')[-1]
-        last_paragraph_words = last_paragraph.split(' ')
-        if len(last_paragraph_words) > 1 and last_paragraph_words[-1].endswith('.'):
-            break
-        final_response = '\n\n'.join(final_response.split('\n\n')[:-1])
-        content_snippet = Snippet(last_paragraph, compression=True, config=prompt_config)
-        prompt = Prompt(prompt_config)
-        prompt.add(*content_snippet.subdivide())
-        prompt.optimize()
-        final_prompt = prompt.build()
 
-    return final_response, prompt
+    completion = do_completion(prompt_config.openai_api_key, final_prompt,
+                               prompt_config.result_tokens,
+                               prompt_config.max_prompt_tokens,
+                               prompt_config.temperature)
+    final_response = completion.text
+
+    # a summary cut off by the result tokens is continued where it stopped: the prompt is
+    # sent again ending with the summary so far, which costs one request per continuation
+    # instead of summarizing the text again
+    start = time.perf_counter()
+    continuations = 0
+    while is_truncated(completion) and continuations < SUMMARY_MAX_CONTINUATIONS:
+        continuation_prompt = final_prompt + final_response
+        # the prompt and the continuation must fit the tokens of one request
+        room = prompt_config.max_tokens - count_tokens(continuation_prompt)
+        if room < MIN_CONTINUATION_TOKENS:
+            break
+        completion = do_completion(prompt_config.openai_api_key, continuation_prompt,
+                                   min(prompt_config.result_tokens, room),
+                                   prompt_config.max_tokens,
+                                   prompt_config.temperature)
+        final_response += completion.text
+        continuations += 1
+
+    truncated = is_truncated(completion)
+    if truncated:
+        # drop the unfinished last paragraph, unless it is all there is
+        paragraphs = final_response.strip().split("\n\n")
+        if len(paragraphs) > 1:
+            final_response = "\n\n".join(paragraphs[:-1])
+
+    seconds = time.perf_counter() - start
+    record_continuations(continuations, truncated, seconds)
+    if continuations:
+        print(f"    continued the summary with {continuations} more requests in {seconds:.2f}s"
+              + (", still unfinished" if truncated else ""))
+
+    return final_response.strip(), prompt
 
 def generate_keywords(prompt_config, prompt):
     keyword_prompt = Prompt(prompt_config)
     keyword_prompt.add(*prompt.get_snippets())
     keyword_prompt.optimize()
     return do_request(prompt_config.openai_api_key, keyword_prompt.build(),
-                      prompt_config.result_tokens, prompt_config.max_chars, prompt_config.temperature)
+                      prompt_config.result_tokens, prompt_config.max_prompt_tokens, prompt_config.temperature)
 
-def handle_text(text: str, max_section_length: int = 5000) -> str:
-    
-    transcript_clean = clean_text(text)
+# group the sentences into sections of less than max_section_length characters
+def split_sections(sentences: List[Sentence], max_section_length: int) -> List[List[Sentence]]:
+    sections = []
+    current_section = []
+    current_length = 0
+
+    for sentence in sentences:
+        if current_section and current_length + len(sentence.text) >= max_section_length:
+            sections.append(current_section)
+            current_section = []
+            current_length = 0
+
+        current_section.append(sentence)
+        current_length += len(sentence.text) + 1
+
+    sections.append(current_section)
+    return sections
+
+def no_progress(step: str, done: int = 0, total: int = 0):
+    pass
+
+# "#tag," and "Tag" become "#tag", like the tags the keyword prompt asks for
+def normalize_keyword(keyword: str) -> str:
+    keyword = keyword.strip().strip(",;.").lstrip("#").lower()
+    return "#" + keyword if keyword else ""
+
+
+# the summary and keywords of a combined extraction response, or None when it is not the
+# JSON asked for. Text around the JSON object, such as a code fence, is ignored
+def parse_extraction(response: str) -> Optional[Tuple[str, List[str]]]:
+    start, end = response.find("{"), response.rfind("}")
+    if start == -1 or end < start:
+        return None
+    try:
+        data = json.loads(response[start:end + 1])
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+
+    topics = data.get("topics")
+    tags = data.get("tags", [])
+    if isinstance(tags, str):
+        tags = tags.replace(",", " ").split()
+    if not isinstance(topics, list) or not topics or not isinstance(tags, list):
+        return None
+
+    paragraphs = []
+    for topic in topics:
+        if not isinstance(topic, dict) or not isinstance(topic.get("paragraph"), str):
+            return None
+        heading = topic.get("heading")
+        if isinstance(heading, str) and heading.strip():
+            paragraphs.append(heading.strip())
+        paragraphs.append(topic["paragraph"].strip())
+
+    keywords = [normalize_keyword(str(tag)) for tag in tags]
+    return "\n\n".join(paragraphs), [keyword for keyword in keywords if keyword]
+
+
+def process_section(prompt_config, keyword_prompt_config, section: List[Sentence], i, total,
+                    progress: Progress = no_progress, extraction_config: Optional[Config] = None
+                    ) -> Tuple[str, List[str]]:
+    print(f"  3.1. Processing section {i + 1}/{total}")
+    progress(f"Processing section {i + 1}/{total}")
+    if extraction_config is not None:
+        response, _ = generate_summary(extraction_config, join_sentences(section), section)
+        result = parse_extraction(response)
+        with _stats_lock:
+            extraction_stats["combined" if result is not None else "fallback"] += 1
+        SECTION_EXTRACTIONS.inc(result="combined" if result is not None else "fallback")
+        if result is not None:
+            return result
+        print(f"  3.1. Could not parse the summary and keywords of section {i + 1}/{total}, "
+              f"requesting them separately")
+
+    summary, summary_prompt = generate_summary(prompt_config, join_sentences(section), section)
+    print(f"  3.2. Generating keywords for section {i + 1}/{total}")
+    progress(f"Generating keywords for section {i + 1}/{total}")
+    keywords = generate_keywords(keyword_prompt_config, summary_prompt)
+    return summary, [keyword for keyword in map(normalize_keyword, keywords.split()) if keyword]
+
+def reduce_summaries(prompt_config, summaries: List[str], max_summary_length: int,
+                     executor: ThreadPoolExecutor) -> List[str]:
+    # summarize neighbouring partial summaries together, level by level, until the
+    # combined summary fits; groups keep their position so the output order is stable
+    level = 1
+    while len(summaries) > 1 and sum(len(s) for s in summaries) > max_summary_length:
+        groups = ["\n\n".join(summaries[i:i + REDUCE_FAN_IN])
+                  for i in range(0, len(summaries), REDUCE_FAN_IN)]
+        print(f"  4.{level}. Reducing {len(summaries)} summaries into {len(groups)}")
+        summaries = [summary for summary, _ in
+                     executor.map(in_context(lambda group: generate_summary(prompt_config, group)), groups)]
+        level += 1
+    return summaries
+
+def handle_text(text: str, max_section_length: int = 5000, concurrency: int = SUMMARY_CONCURRENCY,
+                max_summary_length: Optional[int] = None, progress: Optional[Progress] = None,
+                extraction: str = SUMMARY_EXTRACTION) -> str:
+    """
+    Summarize text of any length by mapping each section to a summary and keywords
+    concurrently, then reducing the partial summaries in section order
+    :param concurrency: the maximum number of sections in flight at once
+    :param max_summary_length: when set, partial summaries are summarized together
+                               until the combined summary is at most this many chars
+    :param progress: called with each step and the number of sections done so far
+    :param extraction: "combined" for one request per section, "separate" for two
+    """
+    sections_done = 0
+    progress_lock = threading.Lock()
+
+    def report(step: str):
+        if progress is not None:
+            with progress_lock:
+                progress(step, sections_done, len(sections))
+
+    start = time.perf_counter()
+    sections = []
+    report("Cleaning text")
+    with stage("clean"):
+        transcript_clean = clean_text(text)
     print("1. Cleaning text")
     prompt_config = Config(
         max_tokens=TOKENS_PER_REQUEST,
@@ -81,92 +299,78 @@ def handle_text(text: str, max_section_length: int = 5000) -> str:
         compression_prefix=COMPRESSION_PREFIX,
         temperature=TEMPERATURE
     )
-
-    print("2. Splitting text into sections")
-
-    # Load the spaCy model
-    nlp = spacy.load("en_core_web_sm")
-
-    # Split the text into sections using spaCy
-    sections = []
-    current_section = ""
-    doc = nlp(transcript_clean)
-
-    for sent in doc.sents:
-        if len(current_section) + len(sent.text) < max_section_length:
-            current_section += sent.text
-        else:
-            sections.append(current_section.strip())
-            current_section = sent.text
-
-    sections.append(current_section.strip())
-
-    print("3. Processing sections")
-    # Process each section and accumulate the summaries and keywords
-    final_summary = ""
-    final_keywords = []
-    for i, section in enumerate(sections):
-        print(f"  3.1. Processing section {i + 1}/{len(sections)}")
-        summary, summary_prompt = generate_summary(prompt_config, section)
-        final_summary += summary
-        print(f"  3.2. Generating keywords for section {i + 1}/{len(sections)}")
-
-        keyword_prompt_config = Config(
+    keyword_prompt_config = Config(
+        max_tokens=TOKENS_PER_REQUEST,
+        result_tokens=RESULT_TOKENS,
+        openai_api_key=OPENAI_API_KEY,
+        final_suffix="",
+        final_prefix=KEYWORD_PREFIX,
+        compression_prefix=KEYWORD_PREFIX,
+        temperature=TEMPERATURE
+    )
+    if extraction == "combined":
+        extraction_config = Config(
             max_tokens=TOKENS_PER_REQUEST,
             result_tokens=RESULT_TOKENS,
             openai_api_key=OPENAI_API_KEY,
-            final_suffix="",
-            final_prefix=KEYWORD_PREFIX,
-            compression_prefix=KEYWORD_PREFIX,
+            final_suffix=EXTRACTION_SUFFIX,
+            final_prefix=EXTRACTION_PREFIX,
+            compression_prefix=COMPRESSION_PREFIX,
             temperature=TEMPERATURE
         )
-        keywords = generate_keywords(keyword_prompt_config, summary_prompt)
-        final_keywords.extend(keywords.split())
-
-    print("4. Combining results")
+    elif extraction == "separate":
+        extraction_config = None
+    else:
+        raise ValueError(f"unknown extraction {extraction!r}, expected combined or separate")
 
-    # Combine the keywords into a single string
-    combined_keywords = " ".join(set(final_keywords))  # Using set to remove duplicates
-
-    return final_summary + "\n\n\n" + combined_keywords
+    print("2. Splitting text into sections")
+    report("Splitting text into sections")
 
+    # Parse the text once, the sentence spans are reused to split sections and snippets
+    sections = split_sections(segment(transcript_clean), max_section_length)
 
+    def process(item):
+        nonlocal sections_done
+        i, section = item
+        with stage("section"):
+            result = process_section(prompt_config, keyword_prompt_config, section, i, len(sections), report,
+                                     extraction_config)
+        with progress_lock:
+            sections_done += 1
+        return result
 
-def url_to_filename(url):
-    new_string = url.replace("/", "-")
-    return hashlib.md5(new_string.encode()).hexdigest()+".md"
+    print("3. Processing sections")
+    # Process the sections concurrently, executor.map yields the results in section order
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        results = list(executor.map(in_context(process), enumerate(sections)))
 
+        summaries = [summary for summary, _ in results]
+        final_keywords = [keyword for _, keywords in results for keyword in keywords]
 
-def handle_url(url: str) -> Tuple[str, str]:
-    from bs4 import BeautifulSoup
+        print("4. Combining results")
+        report("Combining results")
+        if max_summary_length is not None:
+            with stage("reduce"):
+                summaries = reduce_summaries(prompt_config, summaries, max_summary_length, executor)
 
-    # get url contents
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/50.0.2661.102 Safari/537.36'}
-    response = requests.get(url, headers=headers)
-    if response.status_code != 200:
-        print("Error fetching url")
-        # print response body
-        print(response.text)
-        sys.exit(1)
+    final_summary = "".join(summaries)
 
-    html = response.content
+    # Combine the keywords into a single string, without duplicates, in the order they were found
+    combined_keywords = " ".join(dict.fromkeys(final_keywords))
 
-    soup = BeautifulSoup(html, 'html.parser')
+    STAGE_SECONDS.observe(time.perf_counter() - start, stage="handle_text")
+    return final_summary + "\n\n\n" + combined_keywords
 
-    # get the text value of every html element and concatenate it
-    text_val = ''
-    for element in soup.find_all(["title", "meta", "section", "pre", "code", "p", "h1", "h2", "h3", "h4", "h5", "h6"]):
-        element_text = element.text
 
-        if element.name == "meta":
-            if element.get("name") is not None and element["name"] in ["description", "keywords", "author", "og:title", "og:description", "og:url"]:
-                text_val += element_text + "\n"
 
-            continue
-        text_val += element.text.strip() + "\n"
+def handle_url(url: str) -> Tuple[str, str]:
+    page = fetch_page(url)
+    if page.text is None:
+        print("Error fetching url")
+        print(page.error)
+        sys.exit(1)
 
-    text_val = text_val.strip()
+    text_val = page.text
 
     prompt_config = Config(
         max_tokens=TOKENS_PER_REQUEST,
@@ -203,7 +407,7 @@ def handle_url(url: str) -> Tuple[str, str]:
         prompt_config.openai_api_key,
         final_prompt,
         prompt_config.result_tokens,
-        prompt_config.max_chars,
+        prompt_config.max_prompt_tokens,
         prompt_config.temperature
     )
 
@@ -0,0 +1,111 @@
+import base64
+import os
+from functools import lru_cache
+from typing import Dict, Optional
+
+import tiktoken
+import tiktoken.registry
+
+# the BPE files of the encodings the models use, committed so tokens are counted without
+# network access. gpt2, which llama_index counts with, is the first 50257 tokens of p50k_base
+ENCODINGS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "encodings")
+GPT2_PATTERN = r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"""
+CL100K_PATTERN = (r"""(?i:'s|'t|'re|'ve|'m|'ll|'d)|[^\r\n\p{L}\p{N}]?\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]+[\r\n]*|"""
+                  r"""\s*[\r\n]+|\s+(?!\S)|\s+""")
+ENDOFTEXT = "<|endoftext|>"
+
+COMPLETION_MODEL = "text-davinci-003"
+CHAT_MODEL = "gpt-3.5-turbo"
+
+# set TOKEN_COUNTER=estimate to skip the tokenizer and assume 4 characters per token
+ESTIMATE_ONLY = os.getenv("TOKEN_COUNTER") == "estimate"
+CHARS_PER_TOKEN = 4
+# token counts of strings up to this long are memoized, prefixes and repeated sentences mostly
+CACHED_TEXT_CHARS = 1024
+
+
+def load_ranks(file_name: str) -> Dict[bytes, int]:
+    with open(os.path.join(ENCODINGS_DIR, file_name), "rb") as file:
+        return {base64.b64decode(token): int(rank) for token, rank in (line.split() for line in file if line.strip())}
+
+
+def gpt2() -> dict:
+    ranks = load_ranks("p50k_base.tiktoken")
+    return {"name": "gpt2", "explicit_n_vocab": 50257, "pat_str": GPT2_PATTERN,
+            "mergeable_ranks": {token: rank for token, rank in ranks.items() if rank < 50256},
+            "special_tokens": {ENDOFTEXT: 50256}}
+
+
+def p50k_base() -> dict:
+    return {"name": "p50k_base", "explicit_n_vocab": 50281, "pat_str": GPT2_PATTERN,
+            "mergeable_ranks": load_ranks("p50k_base.tiktoken"), "special_tokens": {ENDOFTEXT: 50256}}
+
+
+def cl100k_base() -> dict:
+    return {"name": "cl100k_base", "pat_str": CL100K_PATTERN, "mergeable_ranks": load_ranks("cl100k_base.tiktoken"),
+            "special_tokens": {ENDOFTEXT: 100257, "<|fim_prefix|>": 100258, "<|fim_middle|>": 100259,
+                               "<|fim_suffix|>": 100260, "<|endofprompt|>": 100276}}
+
+
+# have tiktoken build these encodings from the committed files instead of downloading
+# them, for our counts and for the libraries that count with tiktoken too. Each is still
+# loaded on first use
+def install_encodings():
+    with tiktoken.registry._lock:
+        if tiktoken.registry.ENCODING_CONSTRUCTORS is None:
+            tiktoken.registry._find_constructors()
+        tiktoken.registry.ENCODING_CONSTRUCTORS.update(gpt2=gpt2, p50k_base=p50k_base, cl100k_base=cl100k_base)
+
+
+install_encodings()
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> Optional[tiktoken.Encoding]:
+    if ESTIMATE_ONLY:
+        return None
+
+    try:
+        return tiktoken.encoding_for_model(model)
+    except Exception as e:
+        print(f"tokenizer for {model} is unavailable ({e}), estimating {CHARS_PER_TOKEN} chars per token")
+        return None
+
+
+def estimate_tokens(text: str) -> int:
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def _count_tokens(text: str, model: str) -> int:
+    encoding = get_encoding(model)
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode_ordinary(text))
+
+
+_count_tokens_cached = lru_cache(maxsize=65536)(_count_tokens)
+
+
+# the number of model tokens in text
+def count_tokens(text: str, model: str = COMPLETION_MODEL) -> int:
+    if len(text) <= CACHED_TEXT_CHARS:
+        return _count_tokens_cached(text, model)
+    return _count_tokens(text, model)
+
+
+# text cut to at most its first max_tokens model tokens
+def truncate_tokens(text: str, max_tokens: int, model: str = COMPLETION_MODEL) -> str:
+    if max_tokens <= 0:
+        return ""
+    encoding = get_encoding(model)
+    if encoding is None:
+        return text[:max_tokens * CHARS_PER_TOKEN]
+    tokens = encoding.encode_ordinary(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
+
+
+# the number of prompt tokens a chat message costs, including the message framing
+def count_message_tokens(message: dict, model: str = CHAT_MODEL) -> int:
+    return 4 + count_tokens(message["content"], model)
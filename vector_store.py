@@ -0,0 +1,458 @@
+import os
+import sqlite3
+import threading
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from llama_index import Document, GPTSimpleVectorIndex, ServiceContext
+from llama_index.indices.query.schema import QueryBundle
+from llama_index.prompts.default_prompts import DEFAULT_TEXT_QA_PROMPT_TMPL
+
+from llm_client import get_client
+from metrics import stage
+# importing tokens also registers the committed encodings, llama_index counts tokens with
+# gpt2, so indexing, ingest.py included, never downloads it
+from tokens import count_tokens, truncate_tokens
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+# "simple" keeps the whole index in one JSON file, "local" keeps it in VECTOR_STORE_PATH
+VECTOR_STORE = os.getenv("VECTOR_STORE", "simple")
+SIMPLE_INDEX_PATH = "index.json"
+VECTOR_STORE_PATH = os.getenv("VECTOR_STORE_PATH", "vectors")
+# how the local store is searched: "hnswlib" or "faiss" for an HNSW graph, "numpy" for an
+# exact scan, "auto" for the first one installed
+ANN_BACKEND = os.getenv("ANN_BACKEND", "auto")
+# HNSW graph parameters, higher is more accurate and slower
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+# the HNSW graph is written out after this many new rows, rows missing from it are added
+# back from the embeddings file on startup
+ANN_SAVE_EVERY = 10000
+INITIAL_CAPACITY = 1024
+
+# the query action answers from this many documents, as GPTSimpleVectorIndex.query does
+QUERY_TOP_K = 1
+ANSWER_TOKENS = 256
+# text-davinci-003's context, the prompt and the answer share it. A node is cut at up to
+# 3900 gpt2 tokens, so the context is cut to fit, leaving a few tokens spare for where
+# the template and the context meet
+ANSWER_CONTEXT_TOKENS = 4097
+ANSWER_SPARE_TOKENS = 16
+
+
+class Hit(NamedTuple):
+    text: str
+    score: float
+    doc_id: Optional[str]
+    # the session whose turn the node is, None for documents every session shares
+    session: Optional[str] = None
+
+
+# write the index to a temporary file and rename it over save_path, so a crash
+# mid-write never leaves a truncated index behind
+def save_index(index, save_path: str):
+    tmp_path = save_path + ".tmp"
+    with open(tmp_path, "w", encoding="ascii") as file:
+        file.write(index.save_to_string())
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, save_path)
+
+
+# embed texts in requests of the model's batch size. The model's own queue is shared
+# state, going around it lets several threads embed at once
+def embed_texts(service_context: ServiceContext, texts: List[str]) -> List[List[float]]:
+    embed_model = service_context.embed_model
+    size = embed_model._embed_batch_size
+    embeddings = []
+    with stage("embed"):
+        for start in range(0, len(texts), size):
+            embeddings.extend(embed_model._get_text_embeddings(texts[start:start + size]))
+    return embeddings
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class VectorStore:
+    """
+    Where indexed documents are kept and searched. Implementations are safe to use from
+    several threads, and documents are embedded outside their locks.
+    """
+
+    @property
+    def service_context(self) -> ServiceContext:
+        raise NotImplementedError
+
+    # split the documents into nodes, embed and store them. sessions maps the doc_id of a
+    # session's turn to the session, other documents are shared by every session
+    def insert(self, documents: List[Document], sessions: Optional[Dict[str, str]] = None):
+        raise NotImplementedError
+
+    # whether a document with this id has been inserted
+    def __contains__(self, doc_id: str) -> bool:
+        raise NotImplementedError
+
+    # the top_k stored nodes most similar to query, best first. With a session, the turns
+    # of other sessions are left out, and more nodes are looked at until top_k are found
+    def search(self, query: str, top_k: int, session: Optional[str] = None) -> List[Hit]:
+        vector = self.service_context.embed_model.get_query_embedding(query)
+        k = top_k
+        while True:
+            hits = self.search_vector(vector, k)
+            if session is None:
+                return hits
+            visible = [hit for hit in hits if hit.session is None or hit.session == session]
+            if len(visible) >= top_k or len(hits) < k:
+                return visible[:top_k]
+            k *= 4
+
+    # the top_k stored nodes most similar to an embedding, best first, of every session
+    def search_vector(self, vector, top_k: int) -> List[Hit]:
+        raise NotImplementedError
+
+    # answer a question from the most similar nodes, as much of them as fits the prompt
+    def answer(self, query: str, top_k: int = QUERY_TOP_K, session: Optional[str] = None) -> str:
+        context = "\n\n".join(hit.text for hit in self.search(query, top_k, session))
+        room = (ANSWER_CONTEXT_TOKENS - ANSWER_TOKENS - ANSWER_SPARE_TOKENS
+                - count_tokens(DEFAULT_TEXT_QA_PROMPT_TMPL.format(context_str="", query_str=query)))
+        prompt = DEFAULT_TEXT_QA_PROMPT_TMPL.format(context_str=truncate_tokens(context, room), query_str=query)
+        return get_client(os.getenv("OPENAI_API_KEY")).complete(prompt, max_tokens=ANSWER_TOKENS, temperature=0)
+
+    # persist what was inserted
+    def save(self):
+        pass
+
+    def close(self):
+        self.save()
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+
+class SimpleVectorStore(VectorStore):
+    """
+    A GPTSimpleVectorIndex saved as one JSON file, loaded whole into memory and searched
+    exhaustively
+    :param path: the JSON file, the index starts empty if it is missing
+    """
+
+    def __init__(self, path: str = SIMPLE_INDEX_PATH, service_context: Optional[ServiceContext] = None):
+        self.path = path
+        self.lock = threading.RLock()
+        kwargs = {} if service_context is None else {"service_context": service_context}
+        if os.path.exists(path):
+            self.index = GPTSimpleVectorIndex.load_from_disk(path, **kwargs)
+        else:
+            self.index = GPTSimpleVectorIndex.from_documents([], **kwargs)
+
+    @property
+    def service_context(self) -> ServiceContext:
+        return self.index.service_context
+
+    def insert(self, documents: List[Document], sessions: Optional[Dict[str, str]] = None):
+        service_context = self.index.service_context
+        nodes = service_context.node_parser.get_nodes_from_documents(documents)
+        # nodes that already have an embedding are inserted as they are
+        for node, embedding in zip(nodes, embed_texts(service_context, [node.get_text() for node in nodes])):
+            node.embedding = embedding
+            # kept in node_info, extra_info would be embedded and answered from with the text
+            if sessions and node.ref_doc_id in sessions:
+                node.node_info = {**(node.node_info or {}), "session": sessions[node.ref_doc_id]}
+        with self.lock:
+            self.index.insert_nodes(nodes)
+
+    def __contains__(self, doc_id: str) -> bool:
+        with self.lock:
+            return doc_id in self.index.index_struct.doc_id_dict
+
+    # VectorStore.search embeds the query outside the lock, only the lookup holds it. The
+    # answer is VectorStore.answer's, its completion is requested outside the lock too
+    def search_vector(self, vector, top_k: int) -> List[Hit]:
+        with self.lock:
+            response = self.index.query(QueryBundle("", embedding=list(vector)), similarity_top_k=top_k,
+                                        response_mode="no_text")
+        return [Hit(hit.node.get_text(), hit.score or 0.0, hit.node.ref_doc_id, hit.node.get_node_info().get("session"))
+                for hit in response.source_nodes]
+
+    def save(self):
+        with self.lock:
+            save_index(self.index, self.path)
+
+    def __len__(self) -> int:
+        return len(self.index.index_struct.nodes_dict)
+
+
+class _HnswlibIndex:
+    def __init__(self, dim: int, path: str):
+        self.path = path
+        self.index = hnswlib.Index(space="ip", dim=dim)
+        if os.path.exists(path):
+            self.index.load_index(path)
+        else:
+            self.index.init_index(max_elements=INITIAL_CAPACITY, ef_construction=HNSW_EF_CONSTRUCTION, M=HNSW_M)
+        self.index.set_ef(HNSW_EF_SEARCH)
+
+    def __len__(self) -> int:
+        return self.index.get_current_count()
+
+    def add(self, vectors: np.ndarray, start: int):
+        needed = len(self) + len(vectors)
+        if needed > self.index.get_max_elements():
+            self.index.resize_index(max(needed, 2 * self.index.get_max_elements()))
+        self.index.add_items(vectors, np.arange(start, start + len(vectors)))
+
+    def search(self, vector: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        self.index.set_ef(max(HNSW_EF_SEARCH, top_k))
+        rows, distances = self.index.knn_query(vector, k=min(top_k, len(self)))
+        # hnswlib's inner product distance is 1 - similarity
+        return rows[0].astype(np.int64), 1.0 - distances[0]
+
+    def save(self):
+        self.index.save_index(self.path + ".tmp")
+        os.replace(self.path + ".tmp", self.path)
+
+
+class _FaissIndex:
+    def __init__(self, dim: int, path: str):
+        self.path = path
+        if os.path.exists(path):
+            self.index = faiss.read_index(path)
+        else:
+            self.index = faiss.IndexHNSWFlat(dim, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+            self.index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+
+    def __len__(self) -> int:
+        return self.index.ntotal
+
+    # faiss numbers vectors in the order they are added, which matches the rows
+    def add(self, vectors: np.ndarray, start: int):
+        self.index.add(vectors)
+
+    def search(self, vector: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        self.index.hnsw.efSearch = max(HNSW_EF_SEARCH, top_k)
+        scores, rows = self.index.search(vector.reshape(1, -1), min(top_k, len(self)))
+        return rows[0], scores[0]
+
+    def save(self):
+        faiss.write_index(self.index, self.path + ".tmp")
+        os.replace(self.path + ".tmp", self.path)
+
+
+def resolve_backend(backend: str) -> str:
+    if backend == "auto":
+        return "hnswlib" if hnswlib is not None else "faiss" if faiss is not None else "numpy"
+    if backend == "hnswlib" and hnswlib is None or backend == "faiss" and faiss is None:
+        raise ValueError(f"ANN_BACKEND={backend} is not installed, pip install {backend.replace('faiss', 'faiss-cpu')}")
+    if backend not in ("hnswlib", "faiss", "numpy"):
+        raise ValueError(f"unknown ANN_BACKEND {backend!r}, expected auto, hnswlib, faiss or numpy")
+    return backend
+
+
+class LocalVectorStore(VectorStore):
+    """
+    Normalized embeddings in a memory-mapped NumPy file and node texts in SQLite, so
+    opening the store reads neither. Searched through an HNSW graph when hnswlib or faiss
+    is installed, exactly otherwise.
+    :param directory: where the embeddings, the metadata and the graph are kept
+    :param service_context: splits and embeds inserted documents, the default embeds with OpenAI
+    :param backend: "hnswlib", "faiss", "numpy" or "auto", see ANN_BACKEND
+    """
+
+    def __init__(self, directory: str = VECTOR_STORE_PATH, service_context: Optional[ServiceContext] = None,
+                 backend: str = ANN_BACKEND):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.backend = resolve_backend(backend)
+        self._service_context = service_context
+        self.lock = threading.RLock()
+
+        self._db = sqlite3.connect(os.path.join(directory, "metadata.sqlite"), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS nodes "
+                         "(row INTEGER PRIMARY KEY, doc_id TEXT, text TEXT NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS nodes_doc_id ON nodes (doc_id)")
+        # stores made before nodes had a session hold only shared ones
+        if "session" not in [column[1] for column in self._db.execute("PRAGMA table_info(nodes)")]:
+            self._db.execute("ALTER TABLE nodes ADD COLUMN session TEXT")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._db.commit()
+        self._count = self._db.execute("SELECT COUNT(*) FROM nodes").fetchone()[0]
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'dim'").fetchone()
+        self.dim: Optional[int] = int(row[0]) if row else None
+
+        self._embeddings: Optional[np.memmap] = None
+        self._ann = None
+        self._ann_saved = 0
+        if self.dim is not None:
+            self._open()
+
+    @property
+    def service_context(self) -> ServiceContext:
+        if self._service_context is None:
+            self._service_context = ServiceContext.from_defaults()
+        return self._service_context
+
+    @property
+    def _embeddings_path(self) -> str:
+        return os.path.join(self.directory, "embeddings.f32")
+
+    def _open(self):
+        if not os.path.exists(self._embeddings_path):
+            with open(self._embeddings_path, "wb") as file:
+                file.truncate(INITIAL_CAPACITY * self.dim * 4)
+        self._map()
+
+        if self.backend == "numpy":
+            return
+        ann_class = _HnswlibIndex if self.backend == "hnswlib" else _FaissIndex
+        ann_path = os.path.join(self.directory, f"{self.backend}.index")
+        self._ann = ann_class(self.dim, ann_path)
+        if len(self._ann) > self._count:
+            # the graph is ahead of the metadata after a crash, rebuild it
+            os.remove(ann_path)
+            self._ann = ann_class(self.dim, ann_path)
+        self._ann_saved = len(self._ann)
+        for start in range(len(self._ann), self._count, ANN_SAVE_EVERY):
+            end = min(start + ANN_SAVE_EVERY, self._count)
+            self._ann.add(np.ascontiguousarray(self._embeddings[start:end]), start)
+
+    def _map(self):
+        capacity = os.path.getsize(self._embeddings_path) // (self.dim * 4)
+        self._embeddings = np.memmap(self._embeddings_path, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+
+    # grow the embeddings file to hold at least rows rows
+    def _reserve(self, rows: int):
+        capacity = self._embeddings.shape[0]
+        if rows <= capacity:
+            return
+        self._embeddings.flush()
+        self._embeddings = None
+        with open(self._embeddings_path, "r+b") as file:
+            file.truncate(max(rows, 2 * capacity) * self.dim * 4)
+        self._map()
+
+    def insert(self, documents: List[Document], sessions: Optional[Dict[str, str]] = None):
+        nodes = self.service_context.node_parser.get_nodes_from_documents(documents)
+        if not nodes:
+            return
+        texts = [node.get_text() for node in nodes]
+        # embedding is the slow part, searches go on meanwhile
+        embeddings = embed_texts(self.service_context, texts)
+        doc_ids = [node.ref_doc_id for node in nodes]
+        self.add(texts, doc_ids, embeddings, [(sessions or {}).get(doc_id) for doc_id in doc_ids])
+
+    def __contains__(self, doc_id: str) -> bool:
+        with self.lock:
+            return self._db.execute("SELECT 1 FROM nodes WHERE doc_id = ? LIMIT 1", (doc_id,)).fetchone() is not None
+
+    # store already embedded texts, shared by every session unless sessions says otherwise
+    def add(self, texts: List[str], doc_ids: List[Optional[str]], embeddings,
+            sessions: Optional[List[Optional[str]]] = None):
+        if sessions is None:
+            sessions = [None] * len(texts)
+        vectors = normalize(np.asarray(embeddings, dtype=np.float32))
+        with self.lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                self._db.execute("INSERT INTO meta (key, value) VALUES ('dim', ?)", (str(self.dim),))
+                self._open()
+            if vectors.shape[1] != self.dim:
+                raise ValueError(f"embeddings have {vectors.shape[1]} dimensions, the store has {self.dim}")
+
+            start = self._count
+            self._reserve(start + len(vectors))
+            self._embeddings[start:start + len(vectors)] = vectors
+            # the embeddings are on disk before the rows that point at them
+            self._embeddings.flush()
+            self._db.executemany("INSERT INTO nodes (row, doc_id, text, session) VALUES (?, ?, ?, ?)",
+                                 [(start + i, doc_id, text, session)
+                                  for i, (text, doc_id, session) in enumerate(zip(texts, doc_ids, sessions))])
+            self._db.commit()
+            self._count += len(vectors)
+            if self._ann is not None:
+                self._ann.add(vectors, start)
+
+    def search_vector(self, vector, top_k: int) -> List[Hit]:
+        vector = normalize(np.asarray(vector, dtype=np.float32))
+        with self.lock:
+            if not self._count or top_k <= 0:
+                return []
+            if self._ann is not None:
+                rows, scores = self._ann.search(vector, top_k)
+            else:
+                scores = self._embeddings[:self._count] @ vector
+                k = min(top_k, self._count)
+                rows = np.argpartition(-scores, k - 1)[:k]
+                rows = rows[np.argsort(-scores[rows])]
+                scores = scores[rows]
+
+            placeholders = ",".join("?" * len(rows))
+            found = {row: (doc_id, text, session) for row, doc_id, text, session in self._db.execute(
+                f"SELECT row, doc_id, text, session FROM nodes WHERE row IN ({placeholders})",
+                [int(row) for row in rows])}
+        return [Hit(found[row][1], float(score), found[row][0], found[row][2])
+                for row, score in zip(rows.tolist(), scores.tolist()) if row in found]
+
+    # copy the nodes and embeddings of a GPTSimpleVectorIndex without embedding them again
+    def import_index(self, index: GPTSimpleVectorIndex):
+        embeddings = index._vector_store._data.embedding_dict
+        texts, doc_ids, vectors, sessions = [], [], [], []
+        for vector_id, node_id in index.index_struct.nodes_dict.items():
+            if vector_id not in embeddings:
+                continue
+            node = index.docstore.get_node(node_id)
+            texts.append(node.get_text())
+            doc_ids.append(node.ref_doc_id)
+            vectors.append(embeddings[vector_id])
+            sessions.append(node.get_node_info().get("session"))
+        if vectors:
+            self.add(texts, doc_ids, vectors, sessions)
+
+    def save(self):
+        with self.lock:
+            if self._ann is not None and self._count - self._ann_saved >= ANN_SAVE_EVERY:
+                self._ann.save()
+                self._ann_saved = self._count
+
+    def close(self):
+        with self.lock:
+            if self._ann is not None and self._count > self._ann_saved:
+                self._ann.save()
+                self._ann_saved = self._count
+            self._db.close()
+
+    def __len__(self) -> int:
+        return self._count
+
+
+# the store selected by VECTOR_STORE. A new local store starts with the nodes of
+# index.json, a new store otherwise starts with the documents in the data directory
+def open_vector_store(kind: str = VECTOR_STORE, ingest_data: bool = True) -> VectorStore:
+    if kind == "simple":
+        store = SimpleVectorStore(SIMPLE_INDEX_PATH)
+    elif kind == "local":
+        store = LocalVectorStore(VECTOR_STORE_PATH)
+        if not len(store) and os.path.exists(SIMPLE_INDEX_PATH):
+            print(f"importing {SIMPLE_INDEX_PATH} into {VECTOR_STORE_PATH}")
+            store.import_index(GPTSimpleVectorIndex.load_from_disk(SIMPLE_INDEX_PATH))
+    else:
+        raise ValueError(f"unknown VECTOR_STORE {kind!r}, expected simple or local")
+
+    if ingest_data and not len(store) and os.path.isdir("data"):
+        # ingest imports this module
+        from ingest import ingest_directory
+        ingest_directory(store, "data")
+    return store